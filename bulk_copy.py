@@ -0,0 +1,180 @@
+"""Bulk writes against a MySQL target: copying result tables in, deleting by key.
+
+Copies send rows with parameterized executemany (mysql-connector folds it
+into multi-row INSERTs), one transaction per batch. The batch size adapts
+to the measured commit latency and is capped so a batch stays well below
+the server's max_allowed_packet. Deletes split the keys into parameterized
+IN (...) batches bounded by row count and bytes, each committed on its own
+with an optional pause in between. Both run as background jobs.
+"""
+import os
+import time
+
+from export_workers import iter_table_rows
+from sql_literals import quote_identifier, quote_table_name
+
+BULK_COPY_MIN_BATCH = 100
+BULK_COPY_MAX_BATCH = int(os.getenv('BULK_COPY_MAX_BATCH', '50000'))
+# Thời gian mục tiêu (giây) cho mỗi batch/transaction
+BULK_COPY_TARGET_SECONDS = float(os.getenv('BULK_COPY_TARGET_SECONDS', '1.0'))
+
+# Chỉ dùng tối đa phần này của max_allowed_packet cho một câu lệnh
+PACKET_HEADROOM = 0.5
+
+# Số key tối đa trong một câu DELETE ... IN (...)
+DELETE_BATCH_ROWS = int(os.getenv('DELETE_BATCH_ROWS', '5000'))
+# Byte cộng thêm cho mỗi key sau khi escape (dấu nháy, dấu phẩy, khoảng trắng)
+KEY_OVERHEAD_BYTES = 4
+
+def max_allowed_packet(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT @@max_allowed_packet")
+        return int(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+
+class AdaptiveBatchSize:
+    """Batch size steered toward `target_seconds` per batch.
+
+    After each batch the size is scaled by target/measured (clamped to
+    halving or doubling per step) and kept within [minimum, maximum].
+    """
+
+    def __init__(self, initial, target_seconds=BULK_COPY_TARGET_SECONDS,
+                 minimum=BULK_COPY_MIN_BATCH, maximum=BULK_COPY_MAX_BATCH):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target_seconds = target_seconds
+        self.size = self._clamp(initial)
+
+    def _clamp(self, size):
+        return int(min(self.maximum, max(self.minimum, size)))
+
+    def update(self, seconds):
+        factor = self.target_seconds / seconds if seconds > 0 else 2.0
+        self.size = self._clamp(self.size * min(2.0, max(0.5, factor)))
+        return self.size
+
+def insert_sql(table_name, columns, ignore_duplicates=False):
+    placeholders = ', '.join(['%s'] * len(columns))
+    columns_str = ', '.join(quote_identifier(column) for column in columns)
+    verb = "INSERT IGNORE" if ignore_duplicates else "INSERT"
+    return f"{verb} INTO {quote_table_name(table_name)} ({columns_str}) VALUES ({placeholders})"
+
+def run_bulk_copy(job, pool, profile, table_name, table, batch_size=1000, ignore_duplicates=False):
+    """Job: copy every row of a pyarrow Table into `table_name` on `profile`.
+
+    Each batch is committed on its own; on failure the current batch is
+    rolled back and the error reports how many rows were already committed.
+    """
+    total = table.num_rows
+    sql = insert_sql(table_name, table.column_names, ignore_duplicates)
+    copied = 0
+    affected = 0
+    batches = 0
+    started = time.perf_counter()
+    job.progress(0, total, "🔌 Đang kết nối database đích...")
+    with pool.connection(profile) as conn:
+        # Ước lượng kích thước một dòng để batch không vượt max_allowed_packet
+        row_bytes = max(1, 2 * table.nbytes // max(1, total))
+        packet_rows = int(max_allowed_packet(conn) * PACKET_HEADROOM // row_bytes)
+        sizer = AdaptiveBatchSize(batch_size, maximum=min(BULK_COPY_MAX_BATCH, packet_rows))
+        cursor = conn.cursor()
+        try:
+            while copied < total:
+                job.check_cancelled()
+                batch = table.slice(copied, sizer.size)
+                rows = list(iter_table_rows(batch))
+                batch_started = time.perf_counter()
+                try:
+                    conn.start_transaction()
+                    cursor.executemany(sql, rows)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise RuntimeError(f"Batch bắt đầu tại dòng {copied + 1} lỗi ({e}); "
+                                       f"đã ghi thành công {copied} dòng trước đó") from e
+                sizer.update(time.perf_counter() - batch_started)
+                copied += len(rows)
+                affected += max(cursor.rowcount, 0)
+                batches += 1
+                rate = copied / (time.perf_counter() - started)
+                job.progress(copied, total, f"🚚 {copied:,}/{total:,} dòng | {rate:,.0f} dòng/s | batch {sizer.size:,}")
+        finally:
+            cursor.close()
+    seconds = time.perf_counter() - started
+    return {
+        'rows': copied,
+        'affected_rows': affected,
+        'batches': batches,
+        'final_batch_size': sizer.size,
+        'seconds': seconds,
+        'rows_per_second': copied / seconds if seconds else 0.0,
+    }
+
+def delete_sql(table_name, column, key_count):
+    placeholders = ', '.join(['%s'] * key_count)
+    return f"DELETE FROM {quote_table_name(table_name)} WHERE {quote_identifier(column)} IN ({placeholders})"
+
+def iter_key_batches(keys, max_rows=DELETE_BATCH_ROWS, max_bytes=None):
+    """Split keys into lists bounded by `max_rows` keys and about `max_bytes` of SQL"""
+    batch = []
+    batch_bytes = 0
+    for key in keys:
+        key_bytes = len(str(key).encode('utf-8')) + KEY_OVERHEAD_BYTES
+        if batch and (len(batch) >= max_rows or (max_bytes and batch_bytes + key_bytes > max_bytes)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(key)
+        batch_bytes += key_bytes
+    if batch:
+        yield batch
+
+def run_chunked_delete(job, pool, profile, table_name, column, keys, max_rows=DELETE_BATCH_ROWS, pause_seconds=0.0):
+    """Job: delete rows of `table_name` whose `column` is in `keys`, one batch per transaction.
+
+    Returns the deleted-row total and per-batch (first key index, keys,
+    affected rows, seconds). A failing batch is rolled back; earlier
+    batches stay committed.
+    """
+    total = len(keys)
+    done = 0
+    deleted = 0
+    batches = []
+    started = time.perf_counter()
+    job.progress(0, total, "🔌 Đang kết nối database đích...")
+    with pool.connection(profile) as conn:
+        max_bytes = int(max_allowed_packet(conn) * PACKET_HEADROOM)
+        cursor = conn.cursor()
+        try:
+            for batch in iter_key_batches(keys, max_rows, max_bytes):
+                job.check_cancelled()
+                batch_started = time.perf_counter()
+                try:
+                    conn.start_transaction()
+                    cursor.execute(delete_sql(table_name, column, len(batch)), batch)
+                    affected = max(cursor.rowcount, 0)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise RuntimeError(f"Batch {len(batches) + 1} (key {done + 1}-{done + len(batch)}) lỗi ({e}); "
+                                       f"đã xóa {deleted} dòng ở các batch trước") from e
+                batches.append((done, len(batch), affected, time.perf_counter() - batch_started))
+                done += len(batch)
+                deleted += affected
+                job.progress(done, total, f"🗑️ Batch {len(batches)}: {affected:,} dòng | "
+                                          f"đã xóa {deleted:,} dòng, {done:,}/{total:,} key")
+                # Nghỉ giữa các batch để nhường tài nguyên cho traffic production
+                if pause_seconds and done < total:
+                    job.cancel_event.wait(pause_seconds)
+        finally:
+            cursor.close()
+    seconds = time.perf_counter() - started
+    return {
+        'deleted_rows': deleted,
+        'keys': total,
+        'seconds': seconds,
+        'batches': batches,
+    }
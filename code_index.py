@@ -0,0 +1,157 @@
+"""Local SQLite index of the codes table (id, qrcode, serial).
+
+codes_evnhcm only grows by appends, so the index is refreshed
+incrementally: rows with an id above the stored high-water mark are pulled
+page by page with keyset pagination, and each page is committed together
+with the new mark, so an interrupted refresh simply continues next time.
+Lookups then run against the local file without touching MySQL. One index
+file is kept per connection profile (host, user, database and password
+digest), so an account never reads an index built with other credentials.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from code_lookup import LOOKUP_COLUMNS, LOOKUP_TABLE
+from sql_literals import quote_identifier, quote_table_name
+
+CODE_INDEX_DIR = os.path.abspath(os.getenv('CODE_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'code_index')))
+# Cột id tăng dần dùng làm mốc refresh
+CODE_INDEX_ID_COLUMN = os.getenv('CODE_INDEX_ID_COLUMN', 'id')
+# Số dòng lấy từ MySQL mỗi trang khi refresh
+CODE_INDEX_PAGE_SIZE = int(os.getenv('CODE_INDEX_PAGE_SIZE', '50000'))
+# Số tham số mỗi câu IN (...) trên SQLite (giới hạn cũ là 999)
+SQLITE_IN_BATCH = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS codes (id INTEGER PRIMARY KEY, qrcode TEXT, serial TEXT);
+CREATE INDEX IF NOT EXISTS codes_qrcode ON codes (qrcode);
+CREATE INDEX IF NOT EXISTS codes_serial ON codes (serial);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+
+def code_index_path(profile_key, root=CODE_INDEX_DIR):
+    """Index file for a connection profile, keyed like the connection pool (connection_profile_key)"""
+    source = '/'.join([*profile_key, LOOKUP_TABLE])
+    return os.path.join(root, hashlib.sha256(source.encode('utf-8')).hexdigest()[:16] + '.sqlite')
+
+class CodeIndex:
+    """SQLite copy of (id, qrcode, serial) with incremental refresh.
+
+    Connections are opened per call so the index can be shared between
+    sessions and worker threads; refreshes are serialized.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._refresh_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _meta(self, db, key, default=None):
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def stats(self):
+        db = self._connect()
+        try:
+            return {
+                'rows': db.execute("SELECT COUNT(*) FROM codes").fetchone()[0],
+                'high_water': self._meta(db, 'high_water', 0),
+                'refreshed': self._meta(db, 'refreshed'),
+                'bytes': os.path.getsize(self.path),
+            }
+        finally:
+            db.close()
+
+    def refresh(self, conn, progress=None, page_size=CODE_INDEX_PAGE_SIZE):
+        """Pull rows above the high-water mark from MySQL; returns the number of new rows.
+
+        `progress(high_water, max_id)` is called after every committed page.
+        """
+        id_column = quote_identifier(CODE_INDEX_ID_COLUMN)
+        columns_str = ', '.join([id_column] + [quote_identifier(name) for name in LOOKUP_COLUMNS])
+        table = quote_table_name(LOOKUP_TABLE)
+        with self._refresh_lock:
+            db = self._connect()
+            cursor = conn.cursor()
+            try:
+                high_water = self._meta(db, 'high_water', 0)
+                cursor.execute(f"SELECT MAX({id_column}) FROM {table}")
+                max_id = cursor.fetchone()[0] or 0
+                added = 0
+                while high_water < max_id:
+                    cursor.execute(f"SELECT {columns_str} FROM {table} WHERE {id_column} > %s "
+                                   f"ORDER BY {id_column} LIMIT %s", (high_water, page_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    high_water = rows[-1][0]
+                    # Trang dữ liệu và mốc mới được commit cùng nhau
+                    with db:
+                        db.executemany("INSERT OR REPLACE INTO codes (id, qrcode, serial) VALUES (?, ?, ?)", rows)
+                        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('high_water', ?)", (high_water,))
+                    added += len(rows)
+                    if progress:
+                        progress(high_water, max_id)
+                with db:
+                    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('refreshed', ?)", (time.time(),))
+                return added
+            finally:
+                cursor.close()
+                db.close()
+
+    def lookup(self, column, keys):
+        """Rows (dicts of LOOKUP_COLUMNS) whose `column` is in `keys`"""
+        if column not in LOOKUP_COLUMNS:
+            raise ValueError(f"Unknown lookup column: {column}")
+        db = self._connect()
+        try:
+            rows = []
+            for offset in range(0, len(keys), SQLITE_IN_BATCH):
+                batch = keys[offset:offset + SQLITE_IN_BATCH]
+                placeholders = ', '.join(['?'] * len(batch))
+                rows.extend(db.execute(f"SELECT qrcode, serial FROM codes WHERE {column} IN ({placeholders})", batch))
+            return [dict(zip(LOOKUP_COLUMNS, row)) for row in rows]
+        finally:
+            db.close()
+
+def run_code_index_refresh(job, index, pool, profile):
+    """Job: bring the local code index up to date with the live table"""
+    started = time.perf_counter()
+    job.progress(0, 0, "🔌 Đang kết nối database...")
+
+    def report(high_water, max_id):
+        job.check_cancelled()
+        job.progress(high_water, max_id, f"📥 Đã đồng bộ tới id {high_water:,}/{max_id:,}")
+
+    with pool.connection(profile) as conn:
+        added = index.refresh(conn, report)
+    return dict(index.stats(), added=added, seconds=time.perf_counter() - started)
+
+def iter_index_lookups(index, keys_by_column):
+    """Lookup results from the local index, one per key column, shaped like code_lookup's"""
+    columns = [(column, keys) for column, keys in keys_by_column.items() if keys]
+    for batch_no, (column, keys) in enumerate(columns, 1):
+        started = time.perf_counter()
+        rows = index.lookup(column, keys)
+        yield {
+            'column': column,
+            'keys': len(keys),
+            'rows': rows,
+            'seconds': time.perf_counter() - started,
+            'batch': batch_no,
+        }
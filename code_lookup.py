@@ -0,0 +1,224 @@
+"""Serial/QR code lookups against the codes table.
+
+Two strategies share one result shape. By default keys are sent as
+parameterized IN (...) batches of a tunable size; the batches run
+concurrently, each on its own pooled connection, and their rows are
+yielded as soon as a batch finishes. For very large key sets the keys are
+bulk-loaded into a session temporary table instead and resolved with one
+JOIN per key column.
+
+Classifying the uploaded values and assembling the per-row result are
+vectorized pandas operations: keys are deduplicated before querying and the
+found rows are merged back onto the upload in its original order.
+"""
+import math
+import os
+import time
+from concurrent.futures import as_completed
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from sql_literals import quote_identifier, quote_table_name
+
+LOOKUP_TABLE = 'codes_evnhcm'
+LOOKUP_COLUMNS = ('qrcode', 'serial')
+# Serial thuần số được lưu trong DB với prefix này
+SERIAL_PREFIX = '26.'
+
+# Số key trong mỗi câu SELECT ... IN (...) và số batch chạy song song
+LOOKUP_BATCH_SIZE = int(os.getenv('LOOKUP_BATCH_SIZE', '2000'))
+LOOKUP_WORKERS = int(os.getenv('LOOKUP_WORKERS', '4'))
+
+# Từ số key này trở lên dùng bảng tạm + JOIN thay cho các batch IN (...)
+LOOKUP_TEMP_TABLE_MIN_KEYS = int(os.getenv('LOOKUP_TEMP_TABLE_MIN_KEYS', '100000'))
+# Số dòng mỗi lần INSERT vào bảng tạm và mỗi lần fetch kết quả JOIN
+LOOKUP_TEMP_INSERT_BATCH = 10000
+LOOKUP_FETCH_BLOCK_SIZE = 10000
+
+# Nhãn hiển thị của loại dữ liệu và trạng thái tra cứu (cột categorical)
+KIND_LABELS = {'serial': '🔢 Serial', 'qrcode': '🔗 QR Code', 'empty': '❓ Trống'}
+STATUS_FOUND = '✅ Tìm thấy'
+STATUS_NOT_FOUND = '❌ Không tìm thấy'
+STATUS_EMPTY = '⚠️ Trống'
+STATUS_LABELS = [STATUS_FOUND, STATUS_NOT_FOUND, STATUS_EMPTY]
+
+STRATEGY_AUTO = 'auto'
+STRATEGY_BATCHED = 'batched'
+STRATEGY_TEMP_TABLE = 'temp_table'
+
+def lookup_sql(column, key_count, table=LOOKUP_TABLE):
+    columns_str = ', '.join(quote_identifier(name) for name in LOOKUP_COLUMNS)
+    placeholders = ', '.join(['%s'] * key_count)
+    return f"SELECT {columns_str} FROM {quote_table_name(table)} WHERE {quote_identifier(column)} IN ({placeholders})"
+
+def lookup_batch(pool, profile, column, keys):
+    """Rows of the codes table whose `column` is in `keys`, with the query time"""
+    started = time.perf_counter()
+    with pool.connection(profile) as conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(lookup_sql(column, len(keys)), list(keys))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    return {
+        'column': column,
+        'keys': len(keys),
+        'rows': rows,
+        'seconds': time.perf_counter() - started,
+    }
+
+def iter_lookup_batches(keys_by_column, batch_size=LOOKUP_BATCH_SIZE):
+    """(column, keys) for every batch of at most `batch_size` keys"""
+    for column, keys in keys_by_column.items():
+        for offset in range(0, len(keys), batch_size):
+            yield column, keys[offset:offset + batch_size]
+
+def iter_lookups(pool, profile, keys_by_column, executor, batch_size=LOOKUP_BATCH_SIZE):
+    """Run every lookup batch on `executor`, yielding lookup_batch results as they complete.
+
+    Each result also carries its 1-based `batch` number in submission
+    order. The first failing batch raises; batches not yet started are
+    cancelled.
+    """
+    futures = {
+        executor.submit(lookup_batch, pool, profile, column, keys): batch_no
+        for batch_no, (column, keys) in enumerate(iter_lookup_batches(keys_by_column, batch_size), 1)
+    }
+    try:
+        for future in as_completed(futures):
+            yield dict(future.result(), batch=futures[future])
+    finally:
+        for future in futures:
+            future.cancel()
+
+def lookup_strategy(key_count, requested=STRATEGY_AUTO):
+    """The strategy to use for `key_count` keys; 'auto' picks by LOOKUP_TEMP_TABLE_MIN_KEYS"""
+    if requested != STRATEGY_AUTO:
+        return requested
+    return STRATEGY_TEMP_TABLE if key_count >= LOOKUP_TEMP_TABLE_MIN_KEYS else STRATEGY_BATCHED
+
+def lookup_batch_count(keys_by_column, batch_size, strategy):
+    """How many results iter_lookup_results will yield"""
+    if strategy == STRATEGY_TEMP_TABLE:
+        return sum(1 for keys in keys_by_column.values() if keys)
+    return sum(math.ceil(len(keys) / batch_size) for keys in keys_by_column.values())
+
+def _execute_quietly(cursor, sql):
+    try:
+        cursor.execute(sql)
+    except Exception:
+        pass
+
+def lookup_temp_table(conn, column, keys):
+    """Load `keys` into a temporary table and JOIN it against the codes table on `column`.
+
+    The temporary table copies the type and collation of `column` so the
+    JOIN can use its index, and is dropped before returning so the pooled
+    connection goes back clean.
+    """
+    temp_table = quote_identifier(f"_lookup_keys_{column}")
+    key_column = quote_identifier(column)
+    columns_str = ', '.join(f"c.{quote_identifier(name)}" for name in LOOKUP_COLUMNS)
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        _execute_quietly(cursor, f"DROP TEMPORARY TABLE IF EXISTS {temp_table}")
+        cursor.execute(f"CREATE TEMPORARY TABLE {temp_table} (PRIMARY KEY (`k`)) "
+                       f"SELECT {key_column} AS `k` FROM {quote_table_name(LOOKUP_TABLE)} LIMIT 0")
+        # executemany được mysql-connector gộp thành INSERT nhiều dòng; IGNORE bỏ key trùng
+        insert = f"INSERT IGNORE INTO {temp_table} (`k`) VALUES (%s)"
+        for offset in range(0, len(keys), LOOKUP_TEMP_INSERT_BATCH):
+            cursor.executemany(insert, [(key,) for key in keys[offset:offset + LOOKUP_TEMP_INSERT_BATCH]])
+        load_seconds = time.perf_counter() - started
+
+        rows = []
+        join_cursor = conn.cursor(dictionary=True, buffered=False)
+        try:
+            join_cursor.execute(f"SELECT {columns_str} FROM {temp_table} k "
+                                f"JOIN {quote_table_name(LOOKUP_TABLE)} c ON c.{key_column} = k.`k`")
+            for block in iter(lambda: join_cursor.fetchmany(LOOKUP_FETCH_BLOCK_SIZE), []):
+                rows.extend(block)
+        finally:
+            if conn.unread_result:
+                conn.consume_results()
+            join_cursor.close()
+    finally:
+        _execute_quietly(cursor, f"DROP TEMPORARY TABLE IF EXISTS {temp_table}")
+        cursor.close()
+    return {
+        'column': column,
+        'keys': len(keys),
+        'rows': rows,
+        'seconds': time.perf_counter() - started,
+        'load_seconds': load_seconds,
+    }
+
+def iter_lookup_results(pool, profile, keys_by_column, executor, batch_size=LOOKUP_BATCH_SIZE,
+                        strategy=STRATEGY_BATCHED):
+    """Lookup results for every key column using the given (already resolved) strategy.
+
+    The temp-table strategy runs one JOIN per key column on a single pooled
+    connection and yields one result per column.
+    """
+    if strategy != STRATEGY_TEMP_TABLE:
+        yield from iter_lookups(pool, profile, keys_by_column, executor, batch_size)
+        return
+    columns = [(column, keys) for column, keys in keys_by_column.items() if keys]
+    with pool.connection(profile) as conn:
+        for batch_no, (column, keys) in enumerate(columns, 1):
+            yield dict(lookup_temp_table(conn, column, keys), batch=batch_no)
+
+def _string_series(array):
+    return pd.Series(pd.arrays.ArrowStringArray(pa.chunked_array([array], pa.string())))
+
+def classify_lookup_values(values):
+    """Classify uploaded cells: all-digit values are serials, other text is a qrcode.
+
+    Returns a DataFrame aligned with `values` holding the cleaned value, the
+    categorical kind ('serial'/'qrcode'/'empty') and the key searched in the
+    database (serials get SERIAL_PREFIX).
+    """
+    text = pa.array(pd.Series(values).astype('string[pyarrow]').array).cast(pa.string())
+    text = pc.utf8_trim_whitespace(text)
+    empty = pc.is_null(text).to_numpy(zero_copy_only=False)
+    is_serial = pc.fill_null(pc.utf8_is_digit(text), False)
+    db_value = pc.if_else(is_serial, pc.binary_join_element_wise(SERIAL_PREFIX, text, ''), text)
+    kind_codes = (~is_serial.to_numpy(zero_copy_only=False)).astype('int8') + empty.astype('int8')
+    return pd.DataFrame({
+        'value': _string_series(text),
+        'kind': pd.Categorical.from_codes(kind_codes, categories=['serial', 'qrcode', 'empty']),
+        'db_value': _string_series(db_value),
+    })
+
+def lookup_keys(classified):
+    """Distinct database keys per lookup column, in first-seen order"""
+    db_value = pa.array(classified['db_value'].array)
+    return {
+        column: pc.unique(db_value.filter(pa.array((classified['kind'] == column).to_numpy()))).to_pylist()
+        for column in ('serial', 'qrcode')
+    }
+
+def assemble_lookup_results(classified, found_rows):
+    """Per-row lookup result in the upload's order.
+
+    `found_rows` maps a database key to its {'qrcode', 'serial'} row; every
+    upload row is hash-joined to it on its database key. Kind and status are
+    categorical columns labelled with KIND_LABELS and STATUS_LABELS.
+    """
+    found_keys = pa.array(list(found_rows), pa.string())
+    positions = pc.index_in(pa.array(classified['db_value'].array), value_set=found_keys)
+    matched = pc.is_valid(positions).to_numpy(zero_copy_only=False)
+    empty = (classified['kind'] == 'empty').to_numpy()
+    found = pa.array(list(found_rows.values()), pa.struct([(name, pa.string()) for name in LOOKUP_COLUMNS]))
+    columns = {name: _string_series(pc.fill_null(found.field(name).take(positions), '')) for name in LOOKUP_COLUMNS}
+    return pd.DataFrame({
+        'STT': range(1, len(classified) + 1),
+        'Dữ liệu gốc': classified['value'],
+        'Loại': classified['kind'].cat.rename_categories(KIND_LABELS),
+        'qrcode': columns['qrcode'],
+        'serial': columns['serial'],
+        'Trạng thái': pd.Categorical.from_codes((~matched).astype('int8') + empty.astype('int8'), categories=STATUS_LABELS),
+    })
@@ -0,0 +1,413 @@
+"""Background runner for long exports.
+
+Jobs run on a thread pool owned by the Streamlit server process, so they
+keep going across script reruns and while the operator works in other
+tabs. Each job's status is kept in memory and persisted as JSON in
+EXPORT_JOBS_DIR; the UI polls it by job id.
+
+Export jobs checkpoint to a directory per job: the source rows are saved
+as Arrow, every finished chunk file / QR batch is closed into its own
+segment ZIP and checkpoint.json records how far the job got. A failed or
+interrupted job can be resumed from there by the user that submitted it,
+and the segments are merged into the final artifact without compressing
+anything again. Cancelling a job, or discarding a stopped one, deletes its
+directory.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+
+from export_workers import ROW_BATCH_SIZE, ExportArchive, iter_export_chunks, iter_qr_batches, iter_table_rows
+
+# Số export chạy đồng thời
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '3'))
+EXPORT_JOBS_DIR = os.path.abspath(os.getenv('EXPORT_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'export_jobs')))
+EXPORT_JOB_RETENTION_HOURS = float(os.getenv('EXPORT_JOB_RETENTION_HOURS', '72'))
+
+# Ghi trạng thái ra đĩa tối đa mỗi khoảng này (giây) khi job báo tiến độ
+JOB_STATUS_FLUSH_INTERVAL = 1.0
+JOB_ERROR_SAMPLES = 50
+
+ACTIVE_STATES = ('queued', 'running')
+FINAL_STATES = ('done', 'failed', 'cancelled', 'interrupted')
+RESUMABLE_STATES = ('failed', 'interrupted')
+
+PARAMS_FILE = 'params.json'
+CHECKPOINT_FILE = 'checkpoint.json'
+QR_SOURCE_FILE = 'items.arrow'
+SEGMENT_DIR = 'segments'
+
+# Job của chính process này (kể cả của runner khác khi cache bị xóa) không bị coi là gián đoạn
+PROCESS_TOKEN = uuid.uuid4().hex
+
+QR_SOURCE_SCHEMA = pa.schema([('position', pa.int64()), ('name', pa.string()), ('payload', pa.string())])
+
+def write_json(path, data):
+    """Write JSON atomically (temp file + rename)"""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+def read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class JobCancelled(Exception):
+    pass
+
+class ExportJob:
+    """Handle a job function uses to report progress and honour cancellation"""
+
+    def __init__(self, runner, status):
+        self._runner = runner
+        self.status = status
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.dir = runner.job_dir(status['id'])
+        self._flushed = 0.0
+
+    @property
+    def id(self):
+        return self.status['id']
+
+    def progress(self, done, total=None, message=None):
+        self.status['done'] = done
+        if total is not None:
+            self.status['total'] = total
+        if message is not None:
+            self.status['message'] = message
+        now = time.monotonic()
+        if now - self._flushed >= JOB_STATUS_FLUSH_INTERVAL:
+            self._flushed = now
+            self._runner.persist(self.status)
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+class JobRunner:
+    """Runs export jobs in background threads and tracks their status.
+
+    submit() returns a job id; status() works for jobs of this process and,
+    from the persisted JSON, for jobs a restarted server no longer runs
+    (those are reported as 'interrupted'). `owners` are opaque keys of who
+    submitted a job; jobs() and resumable_jobs() only list jobs sharing one
+    of the given keys.
+    """
+
+    def __init__(self, root=EXPORT_JOBS_DIR, max_workers=EXPORT_JOB_WORKERS, retention=EXPORT_JOB_RETENTION_HOURS * 3600):
+        self.root = root
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._recover(retention)
+
+    def submit(self, kind, title, fn, *args, owners=(), **kwargs):
+        """Queue `fn(job, *args, **kwargs)`; its return value becomes the job result"""
+        status = {
+            'id': uuid.uuid4().hex[:12],
+            'kind': kind,
+            'title': title,
+            'owners': list(owners),
+            'state': 'queued',
+            'done': 0,
+            'total': 0,
+            'message': '',
+            'error': None,
+            'result': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+        }
+        return self._start(status, fn, args, kwargs)
+
+    def resume(self, job_id, fn, *args, **kwargs):
+        """Queue a stopped job again under the same id; `fn` continues from its checkpoint"""
+        status = self.status(job_id)
+        if status is None or not self.resumable(status):
+            return False
+        status.update(state='queued', error=None, result=None, finished=None,
+                      resumed=status.get('resumed', 0) + 1)
+        self._start(status, fn, args, kwargs)
+        return True
+
+    def resumable(self, status):
+        return status['state'] in RESUMABLE_STATES and os.path.exists(os.path.join(self.job_dir(status['id']), PARAMS_FILE))
+
+    def jobs(self, owners):
+        """Statuses of every job on disk submitted under one of `owners`, newest first"""
+        owners = set(owners)
+        statuses = (self.status(name[:-5]) for name in os.listdir(self.root) if name.endswith('.json'))
+        return sorted((status for status in statuses if status and owners.intersection(status.get('owners', ()))),
+                      key=lambda status: status['created'], reverse=True)
+
+    def resumable_jobs(self, owners):
+        """Statuses of the owners' stopped jobs that can still be resumed, newest first"""
+        return [status for status in self.jobs(owners) if self.resumable(status)]
+
+    def discard(self, job_id):
+        """Delete the checkpoint and source data of a stopped job so it can no longer be resumed"""
+        status = self.status(job_id)
+        if status is None or status['state'] in ACTIVE_STATES:
+            return False
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        return True
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, os.path.basename(job_id))
+
+    def _start(self, status, fn, args, kwargs):
+        status['owner'] = PROCESS_TOKEN
+        job = ExportJob(self, status)
+        with self._lock:
+            self._jobs[job.id] = job
+        self.persist(status)
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def status(self, job_id):
+        """Snapshot of a job's status dict, or None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return dict(job.status)
+        return self._load(job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.status['state'] not in ACTIVE_STATES:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, 'cancelled')
+        return True
+
+    def persist(self, status):
+        write_json(self._path(status['id']), status)
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_event.is_set():
+            self._finish(job, 'cancelled')
+            return
+        job.status['state'] = 'running'
+        job.status['started'] = time.time()
+        self.persist(job.status)
+        try:
+            result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            self._finish(job, 'failed', error=f"{type(e).__name__}: {e}")
+        else:
+            self._finish(job, 'done', result=result)
+
+    def _finish(self, job, state, result=None, error=None):
+        job.status.update(state=state, result=result, error=error, finished=time.time())
+        self.persist(job.status)
+        if state == 'cancelled':
+            # Job bị hủy không tiếp tục được: xóa luôn bản sao dữ liệu nguồn và các segment
+            shutil.rmtree(job.dir, ignore_errors=True)
+
+    def _recover(self, retention):
+        """Mark jobs left unfinished by a previous server process and drop old ones"""
+        cutoff = time.time() - retention
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            status = self._load(name[:-5])
+            if status is None or status['created'] < cutoff:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+                shutil.rmtree(self.job_dir(name[:-5]), ignore_errors=True)
+            elif status['state'] in ACTIVE_STATES and status.get('owner') != PROCESS_TOKEN:
+                status.update(state='interrupted', finished=time.time())
+                self.persist(status)
+
+    def _load(self, job_id):
+        return read_json(self._path(job_id))
+
+    def _path(self, job_id):
+        return os.path.join(self.root, f"{os.path.basename(job_id)}.json")
+
+def _add_stats(total, stats):
+    for ext, values in stats.items():
+        merged = total.setdefault(ext, {'entries': 0, 'raw_bytes': 0, 'zip_bytes': 0, 'seconds': 0.0})
+        for key, value in values.items():
+            merged[key] += value
+
+def _load_checkpoint(job, **initial):
+    checkpoint = read_json(os.path.join(job.dir, CHECKPOINT_FILE))
+    if checkpoint is None:
+        checkpoint = {'segments': [], 'stats': {}, **initial}
+    os.makedirs(os.path.join(job.dir, SEGMENT_DIR), exist_ok=True)
+    return checkpoint
+
+def _write_segment(job, checkpoint, entries, deflate_executor):
+    """Close `entries` ((entry_name, data)) into the next segment ZIP.
+
+    The caller advances its position and then saves the checkpoint; a crash
+    in between only rewrites this segment on resume.
+    """
+    name = f"seg-{len(checkpoint['segments']):06d}.zip"
+    path = os.path.join(job.dir, SEGMENT_DIR, name)
+    with ExportArchive(path + '.tmp', executor=deflate_executor) as archive:
+        for entry_name, data in entries:
+            archive.writestr(entry_name, data)
+    os.replace(path + '.tmp', path)
+    checkpoint['segments'].append(name)
+    _add_stats(checkpoint['stats'], archive.stats())
+
+def _save_checkpoint(job, checkpoint):
+    write_json(os.path.join(job.dir, CHECKPOINT_FILE), checkpoint)
+
+def _merge_segments(job, store, file_name, checkpoint):
+    """Copy all segments into one artifact, then drop the job's checkpoint data"""
+    job.progress(job.status['done'], message=f"🗜️ Đang ghép {len(checkpoint['segments'])} phần...")
+    with ExportArchive(store.new_temp_path()) as archive:
+        for name in checkpoint['segments']:
+            job.check_cancelled()
+            archive.copy_from(os.path.join(job.dir, SEGMENT_DIR, name))
+    artifact = store.commit(archive.path, file_name)
+    shutil.rmtree(job.dir, ignore_errors=True)
+    return artifact
+
+def _read_arrow_file(path):
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+def _write_arrow_file(path, table):
+    with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(path + '.tmp', path)
+
+def run_file_export(job, store, file_name=None, tasks=None, executor=None, deflate_executor=None):
+    """Job: render chunk export tasks (Excel/SQL/TXT) into one stored ZIP.
+
+    A fresh job saves every task's table to the job directory first; when
+    resumed (no `tasks`) they are read back from there and only chunk files
+    missing from the checkpoint are rendered.
+    """
+    params_path = os.path.join(job.dir, PARAMS_FILE)
+    if tasks is not None:
+        os.makedirs(job.dir, exist_ok=True)
+        job.progress(0, len(tasks), "💾 Đang lưu dữ liệu nguồn...")
+        for i, (fmt, entry_name, table, options) in enumerate(tasks):
+            job.check_cancelled()
+            _write_arrow_file(os.path.join(job.dir, f"source-{i:05d}.arrow"), table)
+        write_json(params_path, {
+            'file_name': file_name,
+            'tasks': [(fmt, entry_name, options) for fmt, entry_name, table, options in tasks],
+        })
+    else:
+        params = read_json(params_path)
+        file_name = params['file_name']
+        tasks = [(fmt, entry_name, _read_arrow_file(os.path.join(job.dir, f"source-{i:05d}.arrow")), options)
+                 for i, (fmt, entry_name, options) in enumerate(params['tasks'])]
+
+    checkpoint = _load_checkpoint(job, next_task=0)
+    done = checkpoint['next_task']
+    job.progress(done, len(tasks), f"📦 Đang tạo file xuất ({done}/{len(tasks)})...")
+    for entry_name, data in iter_export_chunks(tasks[done:], executor):
+        job.check_cancelled()
+        _write_segment(job, checkpoint, [(entry_name, data)], deflate_executor)
+        done += 1
+        checkpoint['next_task'] = done
+        _save_checkpoint(job, checkpoint)
+        job.progress(done, len(tasks), f"📝 Đã xuất file {done}/{len(tasks)}: {entry_name}")
+
+    artifact = _merge_segments(job, store, file_name, checkpoint)
+    return {'artifact': artifact, 'stats': checkpoint['stats'], 'files': len(tasks)}
+
+def _save_qr_source(job, items):
+    """Write the (position, name, payload) items to the job directory as Arrow"""
+    path = os.path.join(job.dir, QR_SOURCE_FILE)
+    with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, QR_SOURCE_SCHEMA) as writer:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= ROW_BATCH_SIZE:
+                job.check_cancelled()
+                writer.write_batch(pa.RecordBatch.from_arrays(list(map(list, zip(*batch))), schema=QR_SOURCE_SCHEMA))
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_arrays(list(map(list, zip(*batch))), schema=QR_SOURCE_SCHEMA))
+    os.replace(path + '.tmp', path)
+
+def run_qr_export(job, store, file_name=None, items=None, total=None, formats=None, box_size=10, border=5,
+                  executor=None, deflate_executor=None, skipped=0):
+    """Job: render QR codes for `items` ((position, base_name, payload)) into one stored ZIP.
+
+    `total` is the number of source rows (positions run from 0 to total-1).
+    Every QR batch becomes one checkpointed segment, so a resumed job (no
+    `items`) only redoes the batches that were in flight. The artifact is
+    None when no QR code could be created.
+    """
+    params_path = os.path.join(job.dir, PARAMS_FILE)
+    if items is not None:
+        os.makedirs(job.dir, exist_ok=True)
+        job.progress(0, total, "💾 Đang lưu dữ liệu nguồn...")
+        _save_qr_source(job, items)
+        write_json(params_path, {
+            'file_name': file_name, 'total': total, 'formats': list(formats),
+            'box_size': box_size, 'border': border, 'skipped': skipped,
+        })
+    else:
+        params = read_json(params_path)
+        file_name, total, formats = params['file_name'], params['total'], params['formats']
+        box_size, border, skipped = params['box_size'], params['border'], params['skipped']
+
+    source = _read_arrow_file(os.path.join(job.dir, QR_SOURCE_FILE))
+    checkpoint = _load_checkpoint(job, next_item=0, position=0, success=0, errors=0, error_samples=[])
+    job.progress(checkpoint['position'], total, "⏳ Đang tạo QR code...")
+    remaining = iter_table_rows(source.slice(checkpoint['next_item']))
+    for batch in iter_qr_batches(remaining, formats, box_size, border, executor):
+        job.check_cancelled()
+        entries = []
+        for position, files, error in batch:
+            if error:
+                checkpoint['errors'] += 1
+                if len(checkpoint['error_samples']) < JOB_ERROR_SAMPLES:
+                    checkpoint['error_samples'].append((position, error))
+                continue
+            entries.extend(files)
+            checkpoint['success'] += 1
+        if entries:
+            _write_segment(job, checkpoint, entries, deflate_executor)
+        checkpoint['next_item'] += len(batch)
+        checkpoint['position'] = position + 1
+        _save_checkpoint(job, checkpoint)
+        job.progress(position + 1, total,
+                     f"⏳ Đang xử lý: {position + 1}/{total} | Thành công: {checkpoint['success']} | "
+                     f"Bỏ qua: {skipped} | Lỗi: {checkpoint['errors']}")
+    job.progress(total, total)
+
+    if checkpoint['success']:
+        artifact = _merge_segments(job, store, file_name, checkpoint)
+    else:
+        shutil.rmtree(job.dir, ignore_errors=True)
+        artifact = None
+    return {
+        'artifact': artifact,
+        'stats': checkpoint['stats'],
+        'total': total,
+        'success': checkpoint['success'],
+        'skipped': skipped,
+        'errors': checkpoint['errors'],
+        'error_samples': checkpoint['error_samples'],
+    }
+
+# Hàm job theo tên (status['kind']) để tiếp tục job đã dừng
+EXPORT_JOB_FUNCTIONS = {fn.__name__: fn for fn in (run_file_export, run_qr_export)}
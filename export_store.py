@@ -0,0 +1,186 @@
+"""On-disk store for finished export archives.
+
+Archives are written to a temp file inside the store, then committed under
+their SHA-256 digest so identical exports share one file. Artifacts expire
+after a TTL and the oldest are evicted once the store exceeds its size
+quota. The default location is ./static/exports so Streamlit static
+serving can stream the files straight from disk; since those URLs bypass
+the app, a background thread removes expired artifacts every
+EXPORT_STORE_CLEANUP_SECONDS.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+
+EXPORT_STORE_DIR = os.path.abspath(os.getenv('EXPORT_STORE_DIR', os.path.join(STATIC_DIR, 'exports')))
+EXPORT_STORE_MAX_GB = float(os.getenv('EXPORT_STORE_MAX_GB', '20'))
+EXPORT_STORE_TTL_HOURS = float(os.getenv('EXPORT_STORE_TTL_HOURS', '24'))
+# Chu kỳ (giây) dọn artifact hết hạn, để link tĩnh ngừng hoạt động đúng hạn
+EXPORT_STORE_CLEANUP_SECONDS = float(os.getenv('EXPORT_STORE_CLEANUP_SECONDS', '60'))
+
+HASH_BLOCK_SIZE = 1024 * 1024
+META_FILE = '.artifact.json'
+INCOMING_DIR = '.incoming'
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class ExportArtifactStore:
+    """Content-addressed export files with size quota and expiry.
+
+    Layout: <root>/<digest>/<file_name> plus a small metadata file per
+    digest. Safe to share between sessions and threads. Expired artifacts are
+    removed every `cleanup_interval` seconds, not only when the store is used.
+    """
+
+    def __init__(self, root=EXPORT_STORE_DIR, max_bytes=int(EXPORT_STORE_MAX_GB * 1024 ** 3),
+                 ttl=EXPORT_STORE_TTL_HOURS * 3600, cleanup_interval=EXPORT_STORE_CLEANUP_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._incoming = os.path.join(root, INCOMING_DIR)
+        self._lock = threading.Lock()
+        os.makedirs(self._incoming, exist_ok=True)
+        self.cleanup()
+        if cleanup_interval:
+            threading.Thread(target=self._cleanup_loop, args=(cleanup_interval,),
+                             name='export-store-cleanup', daemon=True).start()
+
+    def _cleanup_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.cleanup()
+            except OSError:
+                pass
+
+    def new_temp_path(self, suffix='.zip'):
+        """Path of an empty temp file to write an export into before commit()"""
+        fd, path = tempfile.mkstemp(prefix='export_', suffix=suffix, dir=self._incoming)
+        os.close(fd)
+        return path
+
+    def commit(self, temp_path, file_name):
+        """Move a finished temp file into the store and return its artifact dict"""
+        self.cleanup()
+        file_name = os.path.basename(file_name)
+        digest = file_digest(temp_path)
+        with self._lock:
+            artifact_dir = os.path.join(self.root, digest)
+            path = os.path.join(artifact_dir, file_name)
+            meta = self._read_meta(digest)
+            existing = [os.path.join(artifact_dir, name) for name in (meta or {}).get('file_names', [])]
+            existing = [name for name in existing if os.path.exists(name)]
+            if path in existing:
+                # Cùng nội dung và tên file đã có sẵn, chỉ gia hạn
+                os.remove(temp_path)
+            elif existing:
+                # Cùng nội dung nhưng khác tên: hard link thay vì lưu thêm một bản
+                try:
+                    os.link(existing[0], path)
+                    os.remove(temp_path)
+                except OSError:
+                    os.replace(temp_path, path)
+            else:
+                os.makedirs(artifact_dir, exist_ok=True)
+                os.replace(temp_path, path)
+            now = time.time()
+            names = sorted(set((meta or {}).get('file_names', [])) | {file_name})
+            meta = {
+                'digest': digest,
+                'file_names': names,
+                'size': os.path.getsize(path),
+                'created': (meta or {}).get('created', now),
+                'touched': now,
+                'expires': now + self.ttl,
+            }
+            self._write_meta(digest, meta)
+            self._enforce_quota(keep=digest)
+        return self._artifact(meta, file_name)
+
+    def discard(self, temp_path):
+        """Remove a temp file that will not be committed"""
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def get(self, digest, file_name):
+        """Artifact dict for a stored file, or None if it expired or was evicted"""
+        meta = self._read_meta(digest)
+        if meta is None or meta['expires'] < time.time() or file_name not in meta['file_names']:
+            return None
+        artifact = self._artifact(meta, file_name)
+        return artifact if os.path.exists(artifact['path']) else None
+
+    def cleanup(self):
+        """Drop expired artifacts and temp files left behind by failed exports"""
+        now = time.time()
+        with self._lock:
+            for digest, meta in self._iter_meta():
+                if meta is None or meta['expires'] < now:
+                    shutil.rmtree(os.path.join(self.root, digest), ignore_errors=True)
+            for name in os.listdir(self._incoming):
+                path = os.path.join(self._incoming, name)
+                try:
+                    if os.path.getmtime(path) < now - self.ttl:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        metas = [meta for _, meta in self._iter_meta() if meta is not None]
+        return {
+            'artifacts': len(metas),
+            'bytes': sum(meta['size'] for meta in metas),
+            'max_bytes': self.max_bytes,
+        }
+
+    def _enforce_quota(self, keep):
+        metas = sorted((meta for _, meta in self._iter_meta() if meta is not None), key=lambda meta: meta['touched'])
+        total = sum(meta['size'] for meta in metas)
+        for meta in metas:
+            if total <= self.max_bytes:
+                break
+            if meta['digest'] == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, meta['digest']), ignore_errors=True)
+            total -= meta['size']
+
+    def _iter_meta(self):
+        for name in os.listdir(self.root):
+            if name != INCOMING_DIR and os.path.isdir(os.path.join(self.root, name)):
+                yield name, self._read_meta(name)
+
+    def _read_meta(self, digest):
+        try:
+            with open(os.path.join(self.root, digest, META_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, digest, meta):
+        path = os.path.join(self.root, digest, META_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def _artifact(self, meta, file_name):
+        return {
+            'digest': meta['digest'],
+            'file_name': file_name,
+            'path': os.path.join(self.root, meta['digest'], file_name),
+            'size': meta['size'],
+            'expires': meta['expires'],
+        }
@@ -0,0 +1,514 @@
+"""File writers and process-pool entry points used by the export tabs.
+
+Everything here is free of Streamlit so it can be imported by worker
+processes; streamlit_app.py imports these helpers for its exporters.
+"""
+import functools
+import io
+import multiprocessing
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import openpyxl
+import pyarrow as pa
+import qrcode
+import qrcode.constants
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment
+from PIL import Image
+
+from sql_literals import format_insert_statement
+
+ROW_BATCH_SIZE = 10000
+
+# Style tiêu đề dựng sẵn một lần cho mọi file Excel xuất ra
+EXCEL_HEADER_FONT = Font(bold=True)
+EXCEL_HEADER_ALIGNMENT = Alignment(horizontal='center')
+EXCEL_MAX_EXACT_INT = 10 ** 15
+
+# Số mã QR gửi cho mỗi worker process trong một lần
+QR_BATCH_SIZE = int(os.getenv('QR_BATCH_SIZE', '500'))
+
+# Số ma trận QR (dạng bit nén) giữ lại trong mỗi process để không mã hóa lại payload trùng
+# giữa các batch; payload trùng trong cùng batch đã được render_qr_batch dùng lại
+QR_MATRIX_CACHE_SIZE = int(os.getenv('QR_MATRIX_CACHE_SIZE', '1024'))
+
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', str(os.cpu_count() or 1)))
+# Số task tối đa đang chạy/chờ kết quả trên process pool
+PARALLEL_WINDOW = 2 * EXPORT_WORKERS
+
+ZIP_METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+def parse_compression_policy(spec):
+    """Parse "ext=method[:level],..." (e.g. "sql=lzma,txt=deflate:1") into a policy dict"""
+    policy = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        ext, _, setting = item.partition('=')
+        method, _, level = setting.strip().lower().partition(':')
+        if method not in ZIP_METHODS:
+            raise ValueError(f"Unknown archive compression for {ext}: {method}")
+        policy[ext.strip().lower().lstrip('.')] = (method, int(level) if level else None)
+    return policy
+
+# Cách nén từng loại file trong ZIP xuất ra. PNG/JPG và xlsx (bản thân là ZIP)
+# đã nén sẵn nên chỉ lưu thẳng; ghi đè bằng biến môi trường ARCHIVE_COMPRESSION
+ARCHIVE_DEFAULT_COMPRESSION = ('deflate', 6)
+ARCHIVE_COMPRESSION = {
+    'png': ('stored', None),
+    'jpg': ('stored', None),
+    'xlsx': ('stored', None),
+    'svg': ('deflate', 6),
+    'txt': ('deflate', 6),
+    'sql': ('deflate', 6),
+    **parse_compression_policy(os.getenv('ARCHIVE_COMPRESSION', '')),
+}
+
+# File văn bản lớn hơn ngưỡng này được deflate song song theo từng block
+PARALLEL_DEFLATE_MIN_BYTES = int(os.getenv('PARALLEL_DEFLATE_MIN_MB', '4')) * 1024 * 1024
+PARALLEL_DEFLATE_BLOCK_BYTES = 1024 * 1024
+DEFLATE_WINDOW_BYTES = 32 * 1024
+
+def iter_table_rows(table, columns=None, batch_size=ROW_BATCH_SIZE):
+    """Yield rows of a pyarrow Table as tuples, converting one batch at a time"""
+    if columns is not None:
+        table = table.select(list(columns))
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield from zip(*[column.to_pylist() for column in batch.columns])
+
+def table_to_ipc(table):
+    """Serialize a (possibly sliced) table for shipping to a worker process"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def table_from_ipc(buffer):
+    return pa.ipc.open_stream(buffer).read_all()
+
+def _excel_int(value):
+    # Excel chỉ giữ 15 chữ số có nghĩa, số lớn hơn (serial, id dài) ghi dạng text
+    if value is not None and abs(value) >= EXCEL_MAX_EXACT_INT:
+        return str(value)
+    return value
+
+def _excel_str(value):
+    return None if value is None else str(value)
+
+def excel_converters(schema):
+    """Per-column value converters for write_excel_file (None = write as-is)"""
+    converters = []
+    for field in schema:
+        value_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        if pa.types.is_integer(value_type):
+            converters.append(_excel_int)
+        elif (pa.types.is_string(value_type) or pa.types.is_large_string(value_type)
+              or pa.types.is_floating(value_type) or pa.types.is_boolean(value_type)
+              or pa.types.is_decimal(value_type) or pa.types.is_date(value_type)
+              or pa.types.is_time(value_type) or pa.types.is_duration(value_type)
+              or pa.types.is_null(value_type)
+              or (pa.types.is_timestamp(value_type) and value_type.tz is None)):
+            converters.append(None)
+        else:
+            converters.append(_excel_str)
+    return converters
+
+def write_excel_file(file, table, include_headers=True, double_row=False):
+    """Write a pyarrow Table to an .xlsx file (path or binary file object).
+
+    Uses openpyxl's write-only mode, so rows are streamed to the file as
+    they are appended and memory does not grow with the sheet size. Cells
+    keep their native types.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+
+    if include_headers:
+        header_cells = []
+        for header in table.column_names:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.font = EXCEL_HEADER_FONT
+            cell.alignment = EXCEL_HEADER_ALIGNMENT
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+    converters = [(idx, convert) for idx, convert in enumerate(excel_converters(table.schema)) if convert]
+    for record in iter_table_rows(table):
+        if converters:
+            record = list(record)
+            for idx, convert in converters:
+                record[idx] = convert(record[idx])
+        ws.append(record)
+        if double_row:
+            ws.append(record)
+
+    wb.save(file)
+
+def _txt_value(value):
+    if value is None:
+        return ''
+    # Convert to string and handle special characters
+    str_value = str(value).replace('\n', ' ').replace('\r', ' ')
+    # Escape commas in data by wrapping in quotes
+    if ',' in str_value:
+        str_value = f'"{str_value}"'
+    return str_value
+
+def write_txt_file(file, table, include_headers=True, double_row=False):
+    """Write a pyarrow Table as comma separated lines to a binary file object"""
+    lines = []
+    if include_headers:
+        lines.append(','.join(table.column_names))
+    for record in iter_table_rows(table):
+        data_line = ','.join(_txt_value(value) for value in record)
+        lines.append(data_line)
+        if double_row:
+            lines.append(data_line)
+    file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+def write_sql_file(file, table, sql_table_name, double_row=False):
+    """Write a pyarrow Table as one multi-row INSERT statement"""
+    file.write((format_insert_statement(sql_table_name, table, double_row) + "\n").encode('utf-8'))
+
+def render_export_chunk(task):
+    """Render one export chunk file; returns (entry_name, file_bytes).
+
+    `task` is (fmt, entry_name, table_ipc, options) where fmt is one of
+    'xlsx', 'txt' or 'sql'. Runs in worker processes as well as inline.
+    """
+    fmt, entry_name, table_ipc, options = task
+    table = table_from_ipc(table_ipc) if isinstance(table_ipc, pa.Buffer) else table_ipc
+    output = io.BytesIO()
+    if fmt == 'xlsx':
+        write_excel_file(output, table, options.get('include_headers', True), options.get('double_row', False))
+    elif fmt == 'txt':
+        write_txt_file(output, table, options.get('include_headers', True), options.get('double_row', False))
+    elif fmt == 'sql':
+        write_sql_file(output, table, options['sql_table_name'], options.get('double_row', False))
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return entry_name, output.getvalue()
+
+@functools.lru_cache(maxsize=QR_MATRIX_CACHE_SIZE)
+def _encode_qr_packed(payload, version, error_correction):
+    # Lưu 1 bit/module (np.packbits) thay vì tuple bool để cache nhỏ gọn
+    qr = qrcode.QRCode(version=version, error_correction=error_correction, border=0)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return len(qr.modules), np.packbits(np.array(qr.modules, dtype=bool)).tobytes()
+
+def encode_qr_matrix(payload, version=1, error_correction=qrcode.constants.ERROR_CORRECT_M):
+    """Encode a payload and return its module matrix (no border).
+
+    The matrix is a square boolean NumPy array (True = dark module). The
+    packed bits of recent payloads are memoized per worker process.
+    """
+    size, packed = _encode_qr_packed(payload, version, error_correction)
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=size * size)
+    return bits.astype(bool).reshape(size, size)
+
+def _qr_pixels(matrix, box_size, border):
+    """Expand a module matrix to a boolean pixel array (True = white)"""
+    light = ~np.pad(matrix, border, constant_values=False)
+    return np.repeat(np.repeat(light, box_size, axis=0), box_size, axis=1)
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+def encode_png_1bit(pixels):
+    """Encode a boolean pixel array (True = white) as a 1-bit grayscale PNG.
+
+    Every scanline uses the PNG "Up" filter; the box_size repeated lines of a
+    QR code then filter to zeros and deflate to almost nothing.
+    """
+    height, width = pixels.shape
+    packed = np.packbits(pixels, axis=1)
+    filtered = packed.copy()
+    filtered[1:] -= packed[:-1]
+    scanlines = np.empty((height, filtered.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 0] = 2  # filter type Up
+    scanlines[:, 1:] = filtered
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 9)),
+        _png_chunk(b'IEND', b''),
+    ))
+
+def _qr_svg(matrix, box_size, border):
+    # Cùng kích thước với qrcode SvgPathImage: 1 module = box_size/10 mm
+    size = len(matrix) + 2 * border
+    physical = f"{size * box_size / 10:g}mm"
+    path = []
+    for y, row in enumerate(matrix.tolist(), border):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                path.append(f"M{start + border},{y}H{x + border}V{y + 1}H{start + border}z")
+            else:
+                x += 1
+    return (
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        f'<svg width="{physical}" height="{physical}" version="1.1" viewBox="0 0 {size} {size}" '
+        f'xmlns="http://www.w3.org/2000/svg"><path d="{"".join(path)}" id="qr-path" fill="#000000" '
+        'fill-opacity="1" fill-rule="nonzero" stroke="none"/></svg>'
+    ).encode('utf-8')
+
+def render_qr_matrix(matrix, fmt, box_size=10, border=5):
+    """Render an encoded module matrix to image file bytes"""
+    if fmt == 'svg':
+        return _qr_svg(matrix, box_size, border)
+    pixels = _qr_pixels(matrix, box_size, border)
+    if fmt == 'png':
+        return encode_png_1bit(pixels)
+    if fmt == 'jpg':
+        # JPEG không có ảnh 1-bit, dùng grayscale 8-bit thay cho RGB
+        output = io.BytesIO()
+        Image.fromarray(pixels.astype(np.uint8) * 255).save(output, format='JPEG', quality=95)
+        return output.getvalue()
+    raise ValueError(f"Unsupported QR format: {fmt}")
+
+def render_qr_batch(task):
+    """Render a batch of QR codes; runs in worker processes as well as inline.
+
+    `task` is (items, formats, box_size, border) with items as
+    (position, base_name, payload). Each payload is encoded once and drawn
+    in every requested format; identical payloads in the batch reuse the
+    rendered files. Returns one (position, [(entry_name, bytes), ...], error)
+    per item, in input order.
+    """
+    items, formats, box_size, border = task
+    rendered_payloads = {}
+    rendered = []
+    for position, base_name, payload in items:
+        try:
+            files = rendered_payloads.get(payload)
+            if files is None:
+                matrix = encode_qr_matrix(payload)
+                files = [(fmt, render_qr_matrix(matrix, fmt, box_size, border)) for fmt in formats]
+                rendered_payloads[payload] = files
+            rendered.append((position, [(f"{base_name}.{fmt}", data) for fmt, data in files], None))
+        except Exception as e:
+            rendered.append((position, [], str(e)))
+    return rendered
+
+def compression_for(entry_name, policy=None):
+    """(method, level) used for an archive entry, chosen by its extension"""
+    ext = entry_name.rsplit('.', 1)[-1].lower() if '.' in entry_name else ''
+    return (ARCHIVE_COMPRESSION if policy is None else policy).get(ext, ARCHIVE_DEFAULT_COMPRESSION)
+
+def _deflate_block(view, start, end, level):
+    # Mồi dictionary bằng 32KB phía trước để tỉ lệ nén gần bằng deflate một luồng
+    options = {'zdict': view[start - DEFLATE_WINDOW_BYTES if start > DEFLATE_WINDOW_BYTES else 0:start]} if start else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **options)
+    flush_mode = zlib.Z_FINISH if end == len(view) else zlib.Z_SYNC_FLUSH
+    return compressor.compress(view[start:end]) + compressor.flush(flush_mode)
+
+def _iter_file_range(file, size, block_size=PARALLEL_DEFLATE_BLOCK_BYTES):
+    # `size` byte tiếp theo của file, đọc theo từng block
+    while size > 0:
+        block = file.read(min(block_size, size))
+        if not block:
+            raise EOFError("Unexpected end of ZIP entry data")
+        size -= len(block)
+        yield block
+
+class ExportArchive:
+    """ZIP file at `path` that export entries are written straight into.
+
+    Each entry is compressed according to `policy` (file extension ->
+    (method, level)), falling back to ARCHIVE_DEFAULT_COMPRESSION. Deflated
+    entries of PARALLEL_DEFLATE_MIN_BYTES or more are split into blocks and
+    compressed on `executor` threads (zlib releases the GIL), pigz style.
+    Per-format sizes and compression time are collected in stats(). The
+    file is removed again if the export fails.
+    """
+
+    def __init__(self, path, policy=None, executor=None):
+        self.policy = ARCHIVE_COMPRESSION if policy is None else policy
+        self.path = path
+        self._executor = executor
+        self._file = open(path, 'wb')
+        self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_DEFLATED)
+        self._stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        if exc_type is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        return False
+
+    def compression_for(self, entry_name):
+        return compression_for(entry_name, self.policy)
+
+    def writestr(self, entry_name, data):
+        method, level = self.compression_for(entry_name)
+        started = time.perf_counter()
+        if method == 'deflate' and self._executor is not None and len(data) >= PARALLEL_DEFLATE_MIN_BYTES:
+            self._write_parallel_deflate(entry_name, data, level)
+        else:
+            self._zip.writestr(entry_name, data, compress_type=ZIP_METHODS[method], compresslevel=level)
+        self._record(entry_name, len(data), self._zip.filelist[-1].compress_size, time.perf_counter() - started)
+
+    def _write_parallel_deflate(self, entry_name, data, level):
+        view = memoryview(data)
+        bounds = [(start, min(start + PARALLEL_DEFLATE_BLOCK_BYTES, len(view)))
+                  for start in range(0, len(view), PARALLEL_DEFLATE_BLOCK_BYTES)]
+        level = -1 if level is None else level
+        crc = self._executor.submit(zlib.crc32, view)
+        blocks = self._executor.map(lambda bound: _deflate_block(view, bound[0], bound[1], level), bounds)
+
+        zinfo = zipfile.ZipInfo(entry_name, date_time=time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = len(view)
+        zinfo.CRC = crc.result()
+        self._write_compressed(zinfo, blocks)
+
+    def _write_compressed(self, zinfo, chunks):
+        """Write `chunks`, already compressed with zinfo.compress_type, as one entry.
+
+        zinfo.CRC and zinfo.file_size must describe the uncompressed data.
+        ZipFile writes the chunks as a stored entry; the local header is then
+        rewritten with the real method, CRC and size, and the central
+        directory takes them from the same ZipInfo on close.
+        """
+        compress_type, crc, file_size = zinfo.compress_type, zinfo.CRC, zinfo.file_size
+        zinfo.compress_type = zipfile.ZIP_STORED
+        # zip64 luôn bật để header ghi lại có cùng độ dài với header ban đầu
+        with self._zip.open(zinfo, 'w', force_zip64=True) as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+        zinfo.compress_type, zinfo.CRC, zinfo.file_size = compress_type, crc, file_size
+        end = self._file.tell()
+        self._file.seek(zinfo.header_offset)
+        self._file.write(zinfo.FileHeader(zip64=True))
+        self._file.seek(end)
+
+    def copy_from(self, zip_path):
+        """Append every entry of another ZIP without compressing it again"""
+        with open(zip_path, 'rb') as raw, zipfile.ZipFile(raw) as source:
+            bad_entry = source.testzip()
+            if bad_entry is not None:
+                raise ValueError(f"Corrupt entry {bad_entry} in {zip_path}")
+            for info in source.infolist():
+                raw.seek(info.header_offset)
+                header = raw.read(zipfile.sizeFileHeader)
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                raw.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+                zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                zinfo.compress_type = info.compress_type
+                zinfo.external_attr = info.external_attr
+                zinfo.file_size = info.file_size
+                zinfo.CRC = info.CRC
+                # Dữ liệu nén được chép nguyên, từng block một
+                self._write_compressed(zinfo, _iter_file_range(raw, info.compress_size))
+
+    def _record(self, entry_name, raw_bytes, zip_bytes, seconds):
+        ext = entry_name.rsplit('.', 1)[-1].lower() if '.' in entry_name else ''
+        stats = self._stats.setdefault(ext, {'entries': 0, 'raw_bytes': 0, 'zip_bytes': 0, 'seconds': 0.0})
+        stats['entries'] += 1
+        stats['raw_bytes'] += raw_bytes
+        stats['zip_bytes'] += zip_bytes
+        stats['seconds'] += seconds
+
+    def stats(self):
+        """Per-extension entries, raw/compressed bytes and compression seconds"""
+        return {ext: dict(values) for ext, values in self._stats.items()}
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+
+def create_process_pool(max_workers=EXPORT_WORKERS):
+    # spawn: không fork tiến trình server Streamlit đang chạy nhiều thread
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def process_pool_usable(executor):
+    """False once the pool is shut down or broken, e.g. after a worker was OOM-killed"""
+    try:
+        # submit() từ chối ngay khi pool đã hỏng; task rỗng được hủy luôn nếu chưa chạy
+        executor.submit(int).cancel()
+    except (BrokenProcessPool, RuntimeError):
+        return False
+    return True
+
+def iter_parallel_ordered(executor, fn, tasks, window=PARALLEL_WINDOW):
+    """Map `fn` over `tasks` on `executor`, yielding results in task order.
+
+    At most `window` tasks are in flight, so finished results that wait for
+    an earlier slow task never pile up in memory.
+    """
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(executor.submit(fn, task))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Bị dừng giữa chừng (lỗi / hủy job): bỏ các task chưa chạy
+        for future in pending:
+            future.cancel()
+
+def iter_export_chunks(tasks, executor=None, window=PARALLEL_WINDOW):
+    """Render export chunk files, yielding (entry_name, file_bytes) in task order.
+
+    `tasks` are (fmt, entry_name, table, options) as taken by
+    render_export_chunk. With an `executor` the chunks are rendered on that
+    process pool, at most `window` at a time; otherwise one after another
+    in this process.
+    """
+    if executor is not None and len(tasks) > 1:
+        ipc_tasks = ((fmt, entry_name, table_to_ipc(table), options) for fmt, entry_name, table, options in tasks)
+        yield from iter_parallel_ordered(executor, render_export_chunk, ipc_tasks, window)
+    else:
+        for task in tasks:
+            yield render_export_chunk(task)
+
+def iter_qr_batches(items, formats, box_size, border, executor=None, batch_size=QR_BATCH_SIZE,
+                    window=PARALLEL_WINDOW):
+    """Render QR codes in batches, yielding each batch's results in input order.
+
+    `items` yields (position, base_name, payload) and every payload is
+    rendered once per format in `formats`. Each yielded batch is a list of
+    (position, [(entry_name, image_bytes), ...], error) as produced by
+    render_qr_batch. With an `executor` the batches run on that process pool,
+    at most `window` at a time.
+    """
+    def tasks():
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield (batch, formats, box_size, border)
+                batch = []
+        if batch:
+            yield (batch, formats, box_size, border)
+
+    if executor is not None:
+        yield from iter_parallel_ordered(executor, render_qr_batch, tasks(), window)
+    else:
+        for task in tasks():
+            yield render_qr_batch(task)
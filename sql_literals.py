@@ -0,0 +1,148 @@
+"""MySQL literal serialization for pyarrow columns.
+
+The formatter for each column is picked once from its Arrow type and works
+on whole arrays with pyarrow.compute (escaping, casting, joining), so no
+Python code runs per cell for the common types. Every INSERT generator in
+the app goes through format_insert_statement, which keeps their output
+identical.
+"""
+import math
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Escape giống mysql_real_escape_string; '\\' phải thay đầu tiên
+MYSQL_ESCAPES = (
+    ('\\', '\\\\'),
+    ("'", "\\'"),
+    ('"', '\\"'),
+    ('\0', '\\0'),
+    ('\n', '\\n'),
+    ('\r', '\\r'),
+    ('\x1a', '\\Z'),
+)
+
+def quote_identifier(name):
+    return '`' + str(name).replace('`', '``') + '`'
+
+def quote_table_name(name):
+    """Quote `db.table` / `table`; a name the user already quoted is kept as-is"""
+    if '`' in name:
+        return name
+    return '.'.join(quote_identifier(part) for part in name.split('.'))
+
+def escape_string(value):
+    """Escape one Python string for a single-quoted MySQL literal"""
+    for char, escaped in MYSQL_ESCAPES:
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+def _quote(strings):
+    return pc.binary_join_element_wise("'", strings, "'", '')
+
+def _format_null(array):
+    return pa.array(['NULL'] * len(array), pa.string())
+
+def _format_integer(array):
+    return pc.cast(array, pa.string())
+
+def _format_boolean(array):
+    return pc.if_else(array, '1', '0')
+
+def _format_float(array):
+    # NaN/Infinity không có literal trong MySQL -> NULL
+    finite = pc.is_finite(array)
+    return pc.if_else(finite, pc.cast(array, pa.string()), pa.scalar(None, pa.string()))
+
+def _format_decimal(array):
+    return pc.cast(array, pa.string())
+
+def _format_quoted_cast(array):
+    # date, time, timestamp không có timezone: Arrow in ra dạng ISO mà MySQL nhận được
+    return _quote(pc.cast(array, pa.string()))
+
+def _format_string(array):
+    if not pa.types.is_string(array.type):
+        array = pc.cast(array, pa.string())
+    for char, escaped in MYSQL_ESCAPES:
+        array = pc.replace_substring(array, char, escaped)
+    return _quote(array)
+
+def _mysql_time(delta):
+    # mysql-connector trả cột TIME dạng timedelta; MySQL cần [-]HHH:MM:SS[.ffffff]
+    total_us = delta.days * 86400000000 + delta.seconds * 1000000 + delta.microseconds
+    sign = '-' if total_us < 0 else ''
+    seconds, micros = divmod(abs(total_us), 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    fraction = f".{micros:06d}" if micros else ''
+    return f"'{sign}{hours:02d}:{minutes:02d}:{seconds:02d}{fraction}'"
+
+def _python_literal(value):
+    """Literal for one value of a type without a vectorized formatter"""
+    if isinstance(value, (bytes, bytearray)):
+        return f"X'{bytes(value).hex()}'"
+    if hasattr(value, 'total_seconds'):
+        return _mysql_time(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return 'NULL'
+    if isinstance(value, (bool, int, float)):
+        return str(int(value)) if isinstance(value, bool) else str(value)
+    return f"'{escape_string(str(value))}'"
+
+def _format_python(array):
+    return pa.array([None if value is None else _python_literal(value) for value in array.to_pylist()], pa.string())
+
+def _formatter_for(data_type):
+    if pa.types.is_null(data_type):
+        return _format_null
+    if pa.types.is_boolean(data_type):
+        return _format_boolean
+    if pa.types.is_integer(data_type):
+        return _format_integer
+    if pa.types.is_floating(data_type):
+        return _format_float
+    if pa.types.is_decimal(data_type):
+        return _format_decimal
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return _format_string
+    if (pa.types.is_date(data_type) or pa.types.is_time(data_type)
+            or (pa.types.is_timestamp(data_type) and data_type.tz is None)):
+        return _format_quoted_cast
+    if pa.types.is_dictionary(data_type):
+        value_formatter = _formatter_for(data_type.value_type)
+        # Chỉ format các giá trị distinct một lần rồi lấy theo index
+        def format_dictionary(array):
+            return value_formatter(array.dictionary).take(array.indices)
+        return format_dictionary
+    # binary (X'..'), duration (TIME), timestamp có timezone, kiểu lồng nhau...
+    return _format_python
+
+def sql_literal_formatters(schema):
+    """One array formatter per column: Array -> StringArray of SQL literals (nulls kept)"""
+    return [_formatter_for(field.type) for field in schema]
+
+def format_literal_column(formatter, column):
+    """Apply a column formatter to a (Chunked)Array, turning nulls into NULL"""
+    chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+    formatted = [formatter(chunk) for chunk in chunks]
+    literals = pa.chunked_array(formatted, pa.string()) if formatted else pa.chunked_array([], pa.string())
+    return pc.fill_null(literals, 'NULL')
+
+def format_value_rows(table, formatters=None):
+    """The "(v1, v2, ...)" tuple of every row of a table, as a list of str"""
+    if table.num_rows == 0:
+        return []
+    formatters = formatters or sql_literal_formatters(table.schema)
+    columns = [format_literal_column(formatter, column) for formatter, column in zip(formatters, table.columns)]
+    rows = pc.binary_join_element_wise('(', pc.binary_join_element_wise(*columns, ', '), ')', '')
+    return rows.to_pylist()
+
+def format_insert_statement(table_name, table, double_row=False, formatters=None):
+    """One multi-row INSERT statement (ending in ';') for all rows of `table`"""
+    columns_str = ', '.join(quote_identifier(name) for name in table.column_names)
+    rows = format_value_rows(table, formatters)
+    if double_row:
+        rows = [row for row in rows for _ in (0, 1)]
+    return f"INSERT INTO {quote_table_name(table_name)} ({columns_str}) VALUES\n" + ',\n'.join(rows) + ";"
@@ -1,24 +1,102 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import mysql.connector
 import os
 import csv
-import openpyxl
 from openpyxl.styles import Font, Alignment
-import qrcode
-import qrcode.image.svg
 from PIL import Image
 import io
 import tempfile
 import time
-import json
 import math
-import zipfile
+import threading
+import weakref
+import hashlib
+import re
+import html
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from export_workers import (
+    compression_for,
+    create_process_pool,
+    iter_table_rows,
+    process_pool_usable,
+)
+from export_store import ExportArtifactStore, STATIC_DIR
+from sql_literals import (
+    format_insert_statement,
+    format_literal_column,
+    quote_identifier,
+    quote_table_name,
+    sql_literal_formatters,
+)
+from bulk_copy import DELETE_BATCH_ROWS, run_bulk_copy, run_chunked_delete
+from code_lookup import (
+    LOOKUP_BATCH_SIZE,
+    LOOKUP_TEMP_TABLE_MIN_KEYS,
+    LOOKUP_WORKERS,
+    KIND_LABELS,
+    STATUS_EMPTY,
+    STATUS_FOUND,
+    STATUS_NOT_FOUND,
+    STRATEGY_AUTO,
+    STRATEGY_BATCHED,
+    STRATEGY_TEMP_TABLE,
+    assemble_lookup_results,
+    classify_lookup_values,
+    iter_lookup_results,
+    lookup_batch_count,
+    lookup_keys,
+    lookup_strategy,
+)
+from code_index import CodeIndex, code_index_path, iter_index_lookups, run_code_index_refresh
+from export_jobs import ACTIVE_STATES, EXPORT_JOB_FUNCTIONS, JobRunner, run_file_export, run_qr_export
+from contextlib import contextmanager
+
+# Số dòng lấy từ server mỗi lần khi stream kết quả truy vấn
+QUERY_FETCH_BLOCK_SIZE = int(os.getenv('QUERY_FETCH_BLOCK_SIZE', '10000'))
+
+# Kết quả lớn hơn ngưỡng này (MB) sẽ được ghi tạm ra đĩa thay vì giữ trong RAM
+RESULT_MEMORY_BUDGET_MB = int(os.getenv('RESULT_MEMORY_BUDGET_MB', '256'))
+PREVIEW_PAGE_SIZE = 1000
+
+# Cache kết quả truy vấn dùng chung giữa các session
+QUERY_CACHE_MAX_MB = int(os.getenv('QUERY_CACHE_MAX_MB', '512'))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '600'))
+
+# Cache file upload đã parse (Excel/CSV) theo hash nội dung, dùng chung giữa các lần rerun
+UPLOAD_CACHE_MAX_MB = int(os.getenv('UPLOAD_CACHE_MAX_MB', '256'))
+
+# Chu kỳ (giây) thanh bên cập nhật tiến độ các job xuất đang chạy
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1.5'))
+# Tham số URL giữ khóa chủ sở hữu job của tab trình duyệt qua các lần tải lại
+JOB_OWNER_PARAM = 'jobs'
+# Số job gần nhất hiện lại ở thanh bên sau khi tải lại trang
+EXPORT_JOBS_RESTORE_LIMIT = 20
+
+# Streamlit trả 404 cho file tĩnh lớn hơn 200 MB (MAX_APP_STATIC_FILE_SIZE);
+# download_button đọc cả file vào RAM nên cũng giới hạn kích thước
+STATIC_FILE_MAX_BYTES = 200 * 1024 * 1024
+DOWNLOAD_BUTTON_MAX_MB = int(os.getenv('DOWNLOAD_BUTTON_MAX_MB', '200'))
+
+# Số thread deflate song song cho các file văn bản lớn trong ZIP xuất ra
+ARCHIVE_DEFLATE_THREADS = int(os.getenv('ARCHIVE_DEFLATE_THREADS', str(os.cpu_count() or 1)))
+
+# Số lệnh Batch Export chạy song song (mỗi lệnh một connection trong pool)
+BATCH_QUERY_WORKERS = int(os.getenv('BATCH_QUERY_WORKERS', '6'))
+
+# Cấu hình connection pool dùng chung cho toàn bộ process
+POOL_MAX_SIZE = int(os.getenv('POOL_MAX_SIZE', '8'))
+POOL_IDLE_TIMEOUT = float(os.getenv('POOL_IDLE_TIMEOUT', '300'))
+POOL_CHECKOUT_TIMEOUT = float(os.getenv('POOL_CHECKOUT_TIMEOUT', '60'))
 
 def load_csv_connections(uploaded_file):
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
+            df = read_uploaded_frame(uploaded_file, pd.read_csv)
             return df.to_dict('records')
         except Exception as e:
             st.error(f'Error reading CSV file: {str(e)}')
@@ -27,178 +105,996 @@ def load_csv_connections(uploaded_file):
 def load_company_queries(uploaded_file):
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
+            df = read_uploaded_frame(uploaded_file, pd.read_csv)
             return dict(zip(df['company'], df['query']))
         except Exception as e:
             st.error(f'Error reading company queries CSV file: {str(e)}')
     return {}
 
 def connect_to_database(host, user, password, database):
+    """Check the profile against the shared pool and return it on success"""
+    profile = {'host': host, 'user': user, 'password': password, 'database': database}
     try:
-        conn = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database,
+        with get_connection_pool().connection(profile):
+            pass
+        return profile
+    except (mysql.connector.Error, TimeoutError) as err:
+        st.error(f"Database connection error: {err}")
+        return None
+
+def connection_profile_key(profile):
+    """Pool key for a connection profile from the connections CSV.
+
+    The password digest is part of the key so a profile with wrong
+    credentials never receives a warm connection opened by someone else.
+    """
+    password_digest = hashlib.sha256(str(profile['password']).encode('utf-8')).hexdigest()[:16]
+    return (str(profile['host']), str(profile['user']), str(profile['database']), password_digest)
+
+class ConnectionPool:
+    """Process-wide MySQL connection pool keyed by connection profile.
+
+    Idle connections are pinged before reuse and closed once they sit idle
+    longer than `idle_timeout`. At most `max_size` connections (idle + in use)
+    are kept per profile; further checkouts wait up to `checkout_timeout`.
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, checkout_timeout=POOL_CHECKOUT_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self._cond = threading.Condition()
+        self._idle = {}  # key -> [(conn, last_used), ...]
+        self._in_use = {}  # key -> số connection đang được dùng
+        self._stats = {}
+
+    def _key_stats(self, key):
+        return self._stats.setdefault(key, {
+            'checkouts': 0,
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+        })
+
+    def _open(self, profile):
+        return mysql.connector.connect(
+            host=profile['host'],
+            user=profile['user'],
+            password=profile['password'],
+            database=profile['database'],
             connect_timeout=30,  # Thêm timeout cho Streamlit Cloud
             autocommit=True
         )
-        return conn
-    except mysql.connector.Error as err:
-        st.error(f"Database connection error: {err}")
-        return None
 
-def execute_query(conn, query):
-    if not conn:
-        st.warning('Please connect to a database first.')
-        return None
-    
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle_locked(self, now):
+        for key, idle in self._idle.items():
+            keep = []
+            for conn, last_used in idle:
+                if now - last_used > self.idle_timeout:
+                    self._close_quietly(conn)
+                    self._key_stats(key)['discarded'] += 1
+                else:
+                    keep.append((conn, last_used))
+            idle[:] = keep
+
+    def acquire(self, profile):
+        key = connection_profile_key(profile)
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._evict_idle_locked(time.monotonic())
+                idle = self._idle.setdefault(key, [])
+                while not idle and self._in_use.get(key, 0) >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No free connection for {key[0]}/{key[2]} after {self.checkout_timeout}s")
+                    self._cond.wait(remaining)
+                if idle:
+                    conn, _ = idle.pop()
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+
+            if conn is not None:
+                # Health ping trước khi trả connection cũ cho người dùng
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close_quietly(conn)
+                    self._release_slot(key, discarded=True)
+                    continue
+                reused = True
+            else:
+                try:
+                    conn = self._open(profile)
+                except Exception:
+                    self._release_slot(key)
+                    raise
+                reused = False
+
+            waited = time.monotonic() - started
+            with self._cond:
+                stats = self._key_stats(key)
+                stats['checkouts'] += 1
+                stats['reused' if reused else 'created'] += 1
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            return conn
+
+    def _release_slot(self, key, discarded=False):
+        with self._cond:
+            self._in_use[key] = max(0, self._in_use.get(key, 0) - 1)
+            if discarded:
+                self._key_stats(key)['discarded'] += 1
+            self._cond.notify()
+
+    def release(self, profile, conn, discard=False):
+        key = connection_profile_key(profile)
+        if not discard:
+            try:
+                if conn.unread_result:
+                    conn.consume_results()
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard:
+            self._close_quietly(conn)
+            self._release_slot(key, discarded=True)
+            return
+        with self._cond:
+            self._in_use[key] = max(0, self._in_use.get(key, 0) - 1)
+            self._idle.setdefault(key, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, profile):
+        conn = self.acquire(profile)
+        discard = False
+        try:
+            yield conn
+        except mysql.connector.Error:
+            discard = True
+            raise
+        finally:
+            self.release(profile, conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            self._evict_idle_locked(time.monotonic())
+            return {
+                key: dict(stats, idle=len(self._idle.get(key, [])), in_use=self._in_use.get(key, 0))
+                for key, stats in self._stats.items()
+            }
+
+@st.cache_resource
+def get_connection_pool():
+    return ConnectionPool()
+
+def execute_query_stream(conn, query, block_size=QUERY_FETCH_BLOCK_SIZE):
+    """Stream query results in blocks of at most `block_size` rows.
+
+    Uses an unbuffered cursor so rows are pulled from the server as the
+    generator is consumed instead of being materialized up front. Database
+    errors are raised to the caller.
+    """
+    cursor = conn.cursor(dictionary=True, buffered=False)
     try:
-        cursor = conn.cursor(dictionary=True)
         cursor.execute(query)
-        results = cursor.fetchall()
+        while True:
+            rows = cursor.fetchmany(block_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        # Drain unread rows if the consumer stopped early, otherwise the
+        # connection refuses the next statement
+        try:
+            if conn.unread_result:
+                conn.consume_results()
+        except mysql.connector.Error:
+            pass
         cursor.close()
+
+class ResultTable:
+    """Read-only columnar query result backed by a pyarrow Table.
+
+    Columns keep their native types and low-cardinality strings are
+    dictionary encoded, so a result costs a fraction of a list of dicts.
+    The table can be handed to st.dataframe without conversion. Results
+    larger than the memory budget are backed by a memory-mapped Arrow IPC
+    file instead (see ResultTableBuilder); slices of those are paged in
+    from disk on demand.
+    """
+
+    def __init__(self, table, spill_path=None):
+        self.table = table
+        self.spill_path = spill_path
+        if spill_path and os.path.exists(spill_path):
+            weakref.finalize(self, _remove_quietly, spill_path)
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def columns(self):
+        return self.table.column_names
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    @property
+    def spilled(self):
+        return self.spill_path is not None
+
+    def head(self, n):
+        return self.table.slice(0, n)
+
+    def slice(self, offset, length=None):
+        # Giữ tham chiếu tới bảng gốc để file spill không bị xóa khi slice còn dùng
+        sliced = ResultTable(self.table.slice(offset, length))
+        sliced._parent = self
+        return sliced
+
+    def iter_chunks(self, rows_per_chunk):
+        """Yield consecutive zero-copy slices of at most `rows_per_chunk` rows"""
+        for offset in range(0, len(self), rows_per_chunk):
+            yield self.slice(offset, rows_per_chunk)
+
+    def iter_rows(self, columns=None, batch_size=QUERY_FETCH_BLOCK_SIZE):
+        """Yield rows as tuples of Python values, converting one batch at a time"""
+        return iter_table_rows(self.table, columns, batch_size)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class ResultTableBuilder:
+    """Accumulate row blocks from execute_query_stream into a ResultTable.
+
+    Blocks are kept in memory until they exceed `memory_budget` bytes; from
+    then on everything is written to an Arrow IPC file that the finished
+    ResultTable memory-maps, so huge results never have to fit in RAM.
+    """
+
+    def __init__(self, memory_budget=RESULT_MEMORY_BUDGET_MB * 1024 * 1024, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.columns = None
+        self._chunks = None  # mỗi cột một danh sách pyarrow Array
+        self._nbytes = 0
+        self._schema = None
+        self._sink = None
+        self._writer = None
+        self._spill_path = None
+
+    @staticmethod
+    def _to_array(values):
+        try:
+            array = pa.array(values)
+        except OverflowError:
+            # BIGINT UNSIGNED >= 2^63 không vừa int64
+            try:
+                return pa.array(values, type=pa.uint64())
+            except (OverflowError, pa.ArrowInvalid, pa.ArrowTypeError):
+                return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # Cột có kiểu lẫn lộn -> lưu dạng chuỗi như khi xuất file
+            return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+        if pa.types.is_decimal(array.type):
+            # Độ chính xác suy ra từ từng block có thể khác nhau, dùng mức tối đa
+            array = array.cast(pa.decimal128(38, array.type.scale))
+        return array
+
+    @staticmethod
+    def _promote_type(a, b):
+        """Smallest common type of two block types; string when there is none"""
+        if a == b or b == pa.null():
+            return a
+        if a == pa.null():
+            return b
+        if pa.types.is_integer(a) and pa.types.is_integer(b):
+            # int64 + uint64: decimal(20, 0) chứa được cả hai miền giá trị
+            return pa.decimal128(20, 0)
+        if (pa.types.is_decimal(a) or pa.types.is_integer(a)) and (pa.types.is_decimal(b) or pa.types.is_integer(b)):
+            return pa.decimal128(38, max(getattr(a, 'scale', 0), getattr(b, 'scale', 0)))
+        if pa.types.is_floating(a) and pa.types.is_floating(b):
+            return pa.float64()
+        return pa.string()
+
+    @staticmethod
+    def _cast(array, target):
+        if array.type == target:
+            return array
+        if pa.types.is_string(target):
+            return pa.array([None if v is None else str(v) for v in array.to_pylist()], type=pa.string())
+        return array.cast(target)
+
+    def append(self, rows):
+        if not rows:
+            return
+        if self.columns is None:
+            self.columns = list(rows[0].keys())
+            self._chunks = [[] for _ in self.columns]
+        if self._writer is not None:
+            self._write_spilled([self._to_array([row[field.name] for row in rows]) for field in self._schema])
+            return
+        for chunks, column in zip(self._chunks, self.columns):
+            array = self._to_array([row[column] for row in rows])
+            chunks.append(array)
+            self._nbytes += array.nbytes
+        if self._nbytes > self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        table = pa.Table.from_arrays([self._unify(chunks) for chunks in self._chunks], names=self.columns)
+        self._schema = table.schema
+        fd, self._spill_path = tempfile.mkstemp(prefix='result_spill_', suffix='.arrow', dir=self.spill_dir)
+        os.close(fd)
+        self._sink = pa.OSFile(self._spill_path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, self._schema)
+        self._writer.write_table(table, max_chunksize=QUERY_FETCH_BLOCK_SIZE)
+        self._chunks = None
+
+    def _write_spilled(self, arrays):
+        """Append one block to the spill file, widening its schema if the block does not fit"""
+        fields = list(self._schema)
+        for i, (field, array) in enumerate(zip(fields, arrays)):
+            if array.type == field.type:
+                continue
+            try:
+                arrays[i] = array.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                fields[i] = field.with_type(self._promote_type(field.type, array.type))
+        schema = pa.schema(fields)
+        if schema != self._schema:
+            self._respill(schema)
+        arrays = [self._cast(array, field.type) for field, array in zip(schema, arrays)]
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+    def _respill(self, schema):
+        """Rewrite the spill file with a widened schema (rare: e.g. a later block has a larger DECIMAL scale)"""
+        self._writer.close()
+        self._sink.close()
+        old_path = self._spill_path
+        fd, self._spill_path = tempfile.mkstemp(prefix='result_spill_', suffix='.arrow', dir=self.spill_dir)
+        os.close(fd)
+        self._sink = pa.OSFile(self._spill_path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, schema)
+        with pa.memory_map(old_path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                arrays = [self._cast(column, field.type) for column, field in zip(batch.columns, schema)]
+                self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        _remove_quietly(old_path)
+        self._schema = schema
+
+    @classmethod
+    def _unify(cls, chunks):
+        target = pa.null()
+        for chunk in chunks:
+            if chunk.type == target or chunk.type == pa.null():
+                continue
+            try:
+                chunk.cast(target)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                target = cls._promote_type(target, chunk.type)
+        if target == pa.null():
+            target = pa.string()
+        unified = []
+        for chunk in chunks:
+            try:
+                unified.append(cls._cast(chunk, target))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                # Giá trị vượt decimal(38) -> giữ dạng chuỗi
+                return pa.chunked_array([cls._cast(chunk, pa.string()) for chunk in chunks], type=pa.string())
+        return pa.chunked_array(unified, type=target)
+
+    @staticmethod
+    def _compact(column):
+        # Chỉ mã hóa dictionary khi giá trị lặp lại nhiều (vd: tên công ty, trạng thái)
+        if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)) or len(column) == 0:
+            return column
+        if pc.count_distinct(column).as_py() * 2 > len(column):
+            return column
+        return pa.chunked_array([column.combine_chunks().dictionary_encode()])
+
+    def abort(self):
+        """Discard a partially written spill file"""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+                self._sink.close()
+            except Exception:
+                pass
+            _remove_quietly(self._spill_path)
+            self._writer = None
+
+    def finish(self):
+        if self.columns is None:
+            return ResultTable(pa.table({}))
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+            source = pa.memory_map(self._spill_path, 'r')
+            table = pa.ipc.open_file(source).read_all()
+            return ResultTable(table, spill_path=self._spill_path)
+        arrays = [self._compact(self._unify(chunks)) for chunks in self._chunks]
+        return ResultTable(pa.Table.from_arrays(arrays, names=self.columns))
+
+def render_result_preview(results, key, page_size=PREVIEW_PAGE_SIZE):
+    """Show a result in st.dataframe one page at a time"""
+    total = len(results)
+    if total <= page_size:
+        st.dataframe(results.table)
+        return
+    total_pages = math.ceil(total / page_size)
+    page = st.number_input(f"Trang (1-{total_pages})", min_value=1, max_value=total_pages, value=1, key=key)
+    offset = (page - 1) * page_size
+    st.dataframe(results.slice(offset, page_size).table)
+    st.caption(f"Hiển thị dòng {offset + 1}-{min(offset + page_size, total)}/{total}")
+    if results.spilled:
+        st.caption("💾 Kết quả lớn được lưu tạm trên đĩa và đọc theo từng trang")
+
+class LRUByteCache:
+    """Thread-safe LRU cache bounded by the total size of its values.
+
+    Entries older than `ttl` seconds are treated as missing. Hit, miss and
+    eviction counters are kept for display.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            # Giá trị mới thay thế giá trị cũ, kể cả khi quá lớn để lưu
+            if key in self._entries:
+                self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def invalidate(self, predicate):
+        """Drop every entry whose key matches `predicate`; returns how many were dropped"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+@st.cache_resource
+def get_query_cache():
+    return LRUByteCache(QUERY_CACHE_MAX_MB * 1024 * 1024, ttl=QUERY_CACHE_TTL)
+
+@st.cache_resource
+def get_upload_cache():
+    return LRUByteCache(UPLOAD_CACHE_MAX_MB * 1024 * 1024)
+
+def read_uploaded_frame(uploaded_file, reader):
+    """Parse an uploaded file with `reader` (pd.read_excel, pd.read_csv), once per content.
+
+    The DataFrame is cached by the SHA-256 of the file and the reader, so
+    widget reruns reuse it instead of parsing again. The returned frame is
+    shared between reruns and sessions and must not be modified in place.
+    """
+    data = uploaded_file.getvalue()
+    key = (reader.__name__, hashlib.sha256(data).hexdigest())
+    cache = get_upload_cache()
+    df = cache.get(key)
+    if df is None:
+        df = reader(io.BytesIO(data))
+        cache.put(key, df, int(df.memory_usage(deep=True).sum()))
+    return df
+
+_SQL_NORMALIZE_RE = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)|\s+")
+_CACHEABLE_SQL_RE = re.compile(r'^\s*(SELECT|WITH|SHOW|DESCRIBE|DESC|EXPLAIN)\b', re.IGNORECASE)
+
+def normalize_sql(query):
+    """Collapse whitespace outside quoted literals and drop the trailing semicolon"""
+    normalized = _SQL_NORMALIZE_RE.sub(lambda m: m.group(1) or ' ', query).strip()
+    return normalized.rstrip(';').strip()
+
+def load_result_table(profile, query, block_size=QUERY_FETCH_BLOCK_SIZE, bypass_cache=False):
+    """Return (ResultTable, from_cache) for a query, raising database errors.
+
+    Read-only statements are served from the cross-session query cache when
+    possible; `bypass_cache` forces a fresh read and refreshes the entry.
+    """
+    cache_key = None
+    if _CACHEABLE_SQL_RE.match(query):
+        cache_key = (connection_profile_key(profile), normalize_sql(query))
+        if not bypass_cache:
+            cached = get_query_cache().get(cache_key)
+            if cached is not None:
+                return cached, True
+
+    builder = ResultTableBuilder()
+    try:
+        with get_connection_pool().connection(profile) as conn:
+            for rows in execute_query_stream(conn, query, block_size):
+                builder.append(rows)
+    except BaseException:
+        builder.abort()
+        raise
+    results = builder.finish()
+    if cache_key is not None and results:
+        get_query_cache().put(cache_key, results, results.nbytes)
+    return results, False
+
+def fetch_results(profile, query, block_size=QUERY_FETCH_BLOCK_SIZE, bypass_cache=False):
+    """Run a query on a pooled connection and return its rows as a ResultTable"""
+    if not profile:
+        st.warning('Please connect to a database first.')
+        return None
+
+    try:
+        results, from_cache = load_result_table(profile, query, block_size, bypass_cache)
+        if from_cache:
+            st.caption("⚡ Kết quả lấy từ cache")
         return results
-    except mysql.connector.Error as err:
+    except (mysql.connector.Error, TimeoutError, pa.ArrowException) as err:
         st.error(f"Error executing query: {err}")
         return None
 
-def save_results_to_json(results, filename=None):
-    """Save query results to a JSON file for faster processing"""
+def run_batch_query(profile, query, bypass_cache=False):
+    """Run one Batch Export query; safe to call from worker threads.
+
+    Errors are returned instead of raised so the caller can report every
+    query of the batch.
+    """
+    started = time.perf_counter()
     try:
-        # Sử dụng tempfile để tránh vấn đề permissions trên cloud
-        if filename is None:
-            temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json', encoding='utf-8')
-            filename = temp_file.name
-            temp_file.close()
-        
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False)
-        return filename
-    except Exception as e:
-        st.error(f"Error saving results to JSON: {str(e)}")
-        return None
+        results, from_cache = load_result_table(profile, query, bypass_cache=bypass_cache)
+        error = None
+    except (mysql.connector.Error, TimeoutError, pa.ArrowException) as err:
+        results, from_cache, error = None, False, str(err)
+    return {
+        'results': results,
+        'from_cache': from_cache,
+        'error': error,
+        'elapsed': time.perf_counter() - started,
+    }
+
+def render_query_cache_stats():
+    cache = get_query_cache()
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    with st.expander("🗄️ Query cache"):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Entries", stats['entries'])
+        col2.metric("Size", f"{stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MB")
+        col3.metric("Hit rate", f"{stats['hits'] / lookups:.0%}" if lookups else "-")
+        col4.metric("Evictions", stats['evictions'])
+        st.caption(f"Hits: {stats['hits']} | Misses: {stats['misses']} | TTL: {cache.ttl:.0f}s")
+        if st.button("🧹 Xóa cache", key="clear_query_cache"):
+            cache.clear()
+            st.rerun()
+
+@st.cache_resource
+def _export_process_pool():
+    return create_process_pool()
+
+def get_export_process_pool():
+    """Shared export process pool, replaced by a fresh one if a worker died and broke it"""
+    pool = _export_process_pool()
+    if not process_pool_usable(pool):
+        pool.shutdown(wait=False, cancel_futures=True)
+        _export_process_pool.clear()
+        pool = _export_process_pool()
+    return pool
+
+def chunk_file_tasks(results, fmt, base_name, rows_per_file, options, numbered=True):
+    """Split a ResultTable into (fmt, entry_name, table, options) export tasks"""
+    num_chunks = math.ceil(len(results) / rows_per_file)
+    tasks = []
+    for i, chunk in enumerate(results.iter_chunks(rows_per_file)):
+        if numbered or num_chunks > 1:
+            entry_name = f'{base_name}-{i+1:03d}.{fmt}'
+        else:
+            entry_name = f'{base_name}.{fmt}'
+        tasks.append((fmt, entry_name, chunk.table, options))
+    return tasks
+
+@st.cache_resource
+def get_deflate_thread_pool():
+    return ThreadPoolExecutor(max_workers=ARCHIVE_DEFLATE_THREADS, thread_name_prefix='zip-deflate')
+
+@st.cache_resource
+def get_export_store():
+    return ExportArtifactStore()
 
-def load_results_from_json(filename):
-    """Load results from JSON file"""
+@st.cache_resource
+def get_code_index(path):
+    return CodeIndex(path)
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+def job_owner_keys():
+    """Keys the jobs of this session are recorded and listed under.
+
+    One comes from a random token kept in the page URL, so the same browser
+    tab finds its jobs again after a reload, a reconnect or a server restart,
+    with or without a database connection. The other comes from the
+    connected profile, so the same account finds them from another tab.
+    """
+    token = st.query_params.get(JOB_OWNER_PARAM)
+    if not token:
+        token = os.urandom(16).hex()
+        st.query_params[JOB_OWNER_PARAM] = token
+    owners = [token]
+    profile = st.session_state.get('db_profile')
+    if profile:
+        owners.append('/'.join(connection_profile_key(profile)))
+    return [hashlib.sha256(owner.encode('utf-8')).hexdigest()[:16] for owner in owners]
+
+def submit_export_job(title, fn, *args, parallel=True, **kwargs):
+    """Queue an export job (run_file_export / run_qr_export) for this session.
+
+    The job gets the shared artifact store, the process pool when `parallel`
+    and the deflate thread pool; it keeps running across reruns and is
+    followed in the sidebar.
+    """
+    job_id = get_job_runner().submit(
+        fn.__name__, title, fn, get_export_store(), *args,
+        owners=job_owner_keys(),
+        executor=get_export_process_pool() if parallel else None,
+        deflate_executor=get_deflate_thread_pool(),
+        **kwargs
+    )
+    return track_job(job_id, title)
+
+def run_database_write(job, query_cache, fn, pool, profile, *args, **kwargs):
+    """Job: run a write job against `profile`'s database, then drop cached reads of that database.
+
+    The cache is cleared even if the job fails or is cancelled, since some
+    batches may already be committed.
+    """
     try:
-        if not filename or not os.path.exists(filename):
-            return None
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        st.error(f"Error loading results from JSON: {str(e)}")
-        return None
+        return fn(job, pool, profile, *args, **kwargs)
+    finally:
+        host, database = str(profile['host']), str(profile['database'])
+        # Khóa cache: (connection_profile_key, sql) với profile key = (host, user, database, digest)
+        query_cache.invalidate(lambda key: key[0][0] == host and key[0][2] == database)
+
+def submit_bulk_copy_job(profile, table_name, table, batch_size, ignore_duplicates=False):
+    """Queue a direct copy of `table` into `table_name` on the target database"""
+    title = f"Copy → {profile['database']}.{table_name}"
+    job_id = get_job_runner().submit(
+        'run_bulk_copy', title, run_database_write, get_query_cache(), run_bulk_copy,
+        get_connection_pool(), profile, table_name, table,
+        owners=job_owner_keys(), batch_size=batch_size, ignore_duplicates=ignore_duplicates
+    )
+    return track_job(job_id, title)
+
+def submit_chunked_delete_job(profile, table_name, column, keys, max_rows, pause_seconds=0.0):
+    """Queue a batched DELETE of `keys` from `table_name` on the target database"""
+    title = f"Delete ← {profile['database']}.{table_name} ({len(keys):,} key)"
+    job_id = get_job_runner().submit(
+        'run_chunked_delete', title, run_database_write, get_query_cache(), run_chunked_delete,
+        get_connection_pool(), profile, table_name, column, keys,
+        owners=job_owner_keys(), max_rows=max_rows, pause_seconds=pause_seconds
+    )
+    return track_job(job_id, title)
+
+def submit_code_index_refresh_job(profile):
+    """Queue an incremental refresh of the local code index for `profile`'s database"""
+    title = f"Đồng bộ index {profile['database']}"
+    job_id = get_job_runner().submit(
+        'run_code_index_refresh', title, run_code_index_refresh,
+        get_code_index(code_index_path(connection_profile_key(profile))), get_connection_pool(), profile,
+        owners=job_owner_keys()
+    )
+    return track_job(job_id, title)
+
+def track_job(job_id, title):
+    """Follow a submitted job in this session's sidebar panel"""
+    st.session_state['export_jobs'] = [job_id] + st.session_state.get('export_jobs', [])
+    st.success(f"🚀 Đã đưa \"{title}\" vào hàng đợi (job {job_id}). Theo dõi tiến độ ở thanh bên, có thể tiếp tục dùng các tab khác.")
+    return job_id
+
+def resume_export_job(job_id, parallel=True):
+    """Continue a stopped export job from its last checkpoint"""
+    status = get_job_runner().status(job_id)
+    resumed = get_job_runner().resume(
+        job_id, EXPORT_JOB_FUNCTIONS[status['kind']], get_export_store(),
+        executor=get_export_process_pool() if parallel else None,
+        deflate_executor=get_deflate_thread_pool()
+    )
+    if resumed:
+        st.session_state['export_jobs'] = [job_id] + [item for item in st.session_state.get('export_jobs', []) if item != job_id]
+    return resumed
+
+def remember_export(artifact):
+    """Add a stored export to this session's download list"""
+    history = [item for item in st.session_state.get('export_artifacts', []) if item['path'] != artifact['path']]
+    st.session_state['export_artifacts'] = [artifact] + history[:19]
+
+def read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def render_artifact_download(artifact, label, key=None):
+    """Download link for a stored export.
+
+    With static serving enabled the browser downloads the file straight from
+    disk, up to Streamlit's static file size limit. Otherwise a download_button
+    reads the file when clicked, if it is small enough to hold in memory;
+    larger files are only pointed to on disk.
+    """
+    size_mb = artifact['size'] / 1024 / 1024
+    relative = os.path.relpath(artifact['path'], STATIC_DIR)
+    if (st.get_option('server.enableStaticServing') and not relative.startswith('..')
+            and artifact['size'] <= STATIC_FILE_MAX_BYTES):
+        url = 'app/static/' + urllib.parse.quote(relative.replace(os.sep, '/'))
+        st.markdown(
+            f'<a href="{url}" download="{html.escape(artifact["file_name"])}">{html.escape(label)}</a> ({size_mb:.1f} MB)',
+            unsafe_allow_html=True
+        )
+    elif size_mb > DOWNLOAD_BUTTON_MAX_MB:
+        st.warning(f"⚠️ {label} ({size_mb:.1f} MB) quá lớn để tải qua trình duyệt. "
+                   f"Lấy file trực tiếp trên server:")
+        st.code(artifact['path'], language=None)
+    else:
+        path = artifact['path']
+        st.download_button(
+            f"{label} ({size_mb:.1f} MB)",
+            lambda: read_file_bytes(path),
+            file_name=artifact['file_name'],
+            mime="application/zip" if artifact['file_name'].endswith('.zip') else "text/plain",
+            key=key
+        )
+
+def render_export_history():
+    """List this session's exports that are still in the artifact store"""
+    store = get_export_store()
+    artifacts = [store.get(item['digest'], item['file_name']) for item in st.session_state.get('export_artifacts', [])]
+    artifacts = [artifact for artifact in artifacts if artifact is not None]
+    st.session_state['export_artifacts'] = artifacts
+    if not artifacts:
+        return
+    with st.expander(f"📦 File đã xuất ({len(artifacts)})"):
+        for artifact in artifacts:
+            render_artifact_download(artifact, artifact['file_name'], key=f"artifact_{artifact['digest']}_{artifact['file_name']}")
+            st.caption(f"Hết hạn lúc {time.strftime('%d/%m %H:%M', time.localtime(artifact['expires']))}")
+
+def render_export_timings(stats, elapsed):
+    """Show total export time and per-format compression stats of an archive"""
+    compress_seconds = sum(values['seconds'] for values in stats.values())
+    details = []
+    for ext, values in sorted(stats.items()):
+        method, level = compression_for(f"x.{ext}")
+        details.append(f"{ext} ({method}{'' if level is None else f':{level}'}): {values['entries']} file, "
+                       f"{values['raw_bytes'] / 1024 / 1024:.1f} → {values['zip_bytes'] / 1024 / 1024:.1f} MB, "
+                       f"{values['seconds']:.2f}s")
+    st.caption(f"⏱️ Tổng {elapsed:.2f}s | Nén ZIP {compress_seconds:.2f}s | " + " · ".join(details))
+
+def render_job_result(status):
+    """Outcome of a finished export job: download link, timings and QR counts"""
+    result = status['result'] or {}
+    if result.get('artifact'):
+        remember_export(result['artifact'])
+        render_artifact_download(result['artifact'], "📥 Tải xuống (ZIP)", key=f"job_download_{status['id']}")
+    if 'success' in result:
+        st.caption(f"✅ Thành công: {result['success']} | ⏭️ Bỏ qua: {result['skipped']} | ❌ Lỗi: {result['errors']}")
+        if not result['success']:
+            st.error("❌ Không tạo được QR code nào. Vui lòng kiểm tra lại dữ liệu!")
+        for position, error in result['error_samples']:
+            st.warning(f"⚠️ Lỗi tại dòng {position + 1}: {error}")
+    if result.get('stats'):
+        render_export_timings(result['stats'], status['finished'] - status['started'])
+    if 'rows_per_second' in result:
+        st.caption(f"🚚 Đã copy {result['rows']:,} dòng ({result['affected_rows']:,} dòng được ghi) trong "
+                   f"{result['seconds']:.1f}s | {result['rows_per_second']:,.0f} dòng/s | "
+                   f"{result['batches']} batch, batch cuối {result['final_batch_size']:,} dòng")
+    if 'high_water' in result:
+        st.caption(f"🗂️ Thêm {result['added']:,} mã trong {result['seconds']:.1f}s | "
+                   f"index có {result['rows']:,} mã, tới id {result['high_water']:,}")
+    if 'deleted_rows' in result:
+        st.caption(f"🗑️ Đã xóa {result['deleted_rows']:,} dòng cho {result['keys']:,} key trong "
+                   f"{result['seconds']:.1f}s | {len(result['batches'])} batch")
+        if result['batches']:
+            batches = pd.DataFrame(
+                [(start + 1, keys, affected, round(seconds, 3)) for start, keys, affected, seconds in result['batches']],
+                columns=["Key từ", "Số key", "Dòng bị xóa", "Giây"],
+            )
+            st.dataframe(batches, hide_index=True, height=150)
+
+def render_export_jobs_panel(job_ids, was_active):
+    runner = get_job_runner()
+    statuses = [status for status in (runner.status(job_id) for job_id in job_ids) if status]
+    for status in statuses:
+        st.markdown(f"**{status['title']}** · `{status['id']}`")
+        if status['state'] in ACTIVE_STATES:
+            fraction = min(status['done'] / status['total'], 1.0) if status['total'] else 0.0
+            st.progress(fraction, text=status['message'] or "⏳ Đang chờ...")
+            if st.button("✋ Hủy", key=f"cancel_job_{status['id']}"):
+                runner.cancel(status['id'])
+        elif status['state'] == 'done':
+            render_job_result(status)
+        else:
+            if status['state'] == 'failed':
+                st.error(f"❌ Lỗi: {status['error']}")
+            elif status['state'] == 'cancelled':
+                st.warning("✋ Đã hủy")
+            else:
+                st.warning("⚠️ Bị gián đoạn do server khởi động lại")
+            if runner.resumable(status):
+                resume_col, discard_col = st.columns(2)
+                if resume_col.button(f"▶️ Tiếp tục từ {status['done']}/{status['total']}", key=f"resume_job_{status['id']}"):
+                    resume_export_job(status['id'])
+                    st.rerun()
+                if discard_col.button("🗑️ Bỏ", key=f"discard_job_{status['id']}"):
+                    runner.discard(status['id'])
+                    st.rerun()
+    if was_active and not any(status['state'] in ACTIVE_STATES for status in statuses):
+        # Tất cả job đã xong: chạy lại toàn trang để tắt polling
+        st.rerun()
+
+def render_export_jobs():
+    """Sidebar panel following this session's export jobs.
+
+    While a job is queued or running the panel is a fragment that refreshes
+    itself every JOB_POLL_INTERVAL seconds without rerunning the page.
+    After a page reload the owner's queued, running and finished jobs are
+    listed again. Stopped jobs with a checkpoint, including those the same
+    user started in earlier sessions, can be resumed or discarded from here.
+    """
+    runner = get_job_runner()
+    if 'export_jobs' not in st.session_state:
+        # Session mới (tải lại trang, mất kết nối): lấy lại các job đang chạy / đã xong của cùng chủ sở hữu
+        st.session_state['export_jobs'] = [
+            status['id'] for status in runner.jobs(job_owner_keys())
+            if status['state'] in ACTIVE_STATES or status['state'] == 'done'
+        ][:EXPORT_JOBS_RESTORE_LIMIT]
+    job_ids = st.session_state['export_jobs']
+    # Job dừng giữa chừng của session cũ (vd. server khởi động lại) vẫn tiếp tục được
+    orphaned = [status for status in runner.resumable_jobs(job_owner_keys()) if status['id'] not in job_ids]
+    if orphaned:
+        with st.expander(f"♻️ Export có thể tiếp tục ({len(orphaned)})"):
+            for status in orphaned:
+                st.markdown(f"**{status['title']}** · `{status['id']}` · {status['done']}/{status['total']}")
+                resume_col, discard_col = st.columns(2)
+                if resume_col.button("▶️ Tiếp tục", key=f"resume_orphan_{status['id']}"):
+                    resume_export_job(status['id'])
+                    st.rerun()
+                if discard_col.button("🗑️ Bỏ", key=f"discard_orphan_{status['id']}"):
+                    runner.discard(status['id'])
+                    st.rerun()
+    if not job_ids:
+        return
+    active = any((runner.status(job_id) or {}).get('state') in ACTIVE_STATES for job_id in job_ids)
+    with st.expander(f"⚙️ Tác vụ xuất ({len(job_ids)})", expanded=True):
+        st.fragment(render_export_jobs_panel, run_every=JOB_POLL_INTERVAL if active else None)(job_ids, active)
+        if not active and st.button("🧹 Xóa danh sách tác vụ", key="clear_export_jobs"):
+            st.session_state['export_jobs'] = []
+            st.rerun()
+
+def clean_image_name(raw_name, fallback):
+    """Turn a cell value into a safe image file name (without extension)"""
+    # Replace newlines, tabs, and other control characters with space
+    clean_name = str(raw_name).replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
+    # Remove invalid Windows filename characters
+    for char in '<>:"/\\|?*':
+        clean_name = clean_name.replace(char, '_')
+    # Remove leading/trailing spaces and dots, limit length (Windows has 255 char limit)
+    clean_name = clean_name.strip('. ')[:200]
+    # Ensure filename is not empty
+    return clean_name or fallback
 
 def generate_insert_query_batched(table_name, selected_columns, results, batch_size=1000):
-    """Generate INSERT queries in batches"""
-    if not results or not selected_columns or not table_name:
-        return None
-    
-    # Calculate total batches
-    total_records = len(results)
-    total_batches = math.ceil(total_records / batch_size)
-    
-    # Create progress bar
+    """Yield one INSERT statement per batch of rows, read straight from the result table"""
+    columns = list(selected_columns)
+    # Column formatters are chosen once from the Arrow schema
+    formatters = sql_literal_formatters(results.table.select(columns).schema)
+    for batch in results.iter_chunks(batch_size):
+        yield format_insert_statement(table_name, batch.table.select(columns), formatters=formatters)
+
+def write_sql_artifact(statements, file_name, total_batches):
+    """Stream statements into a .sql file of the artifact store.
+
+    Only one batch is in memory at a time. Returns (artifact, first statement)
+    so the caller can preview the first batch without reading the file back.
+    """
+    store = get_export_store()
+    path = store.new_temp_path(suffix='.sql')
     progress_bar = st.progress(0)
     status_text = st.empty()
-    
-    # Sử dụng tempfile cho Streamlit Cloud
-    temp_json = None
-    temp_sql = None
-    
+    first_statement = None
     try:
-        # Save results to temp JSON file
-        temp_json = save_results_to_json(results)
-        if not temp_json:
-            return None
-        
-        # Generate base query
-        columns_str = ', '.join(selected_columns)
-        base_query = f"INSERT INTO {table_name} ({columns_str}) VALUES\n"
-        
-        # Tạo temp file cho SQL queries
-        temp_sql_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.sql', encoding='utf-8')
-        temp_sql = temp_sql_file.name
-        
-        # Load results from JSON
-        results = load_results_from_json(temp_json)
-        if not results:
-            return None
-        
-        # Process in batches
-        for batch_num in range(total_batches):
-            start_idx = batch_num * batch_size
-            end_idx = min((batch_num + 1) * batch_size, total_records)
-            batch = results[start_idx:end_idx]
-            
-            values_list = []
-            for row in batch:
-                values = []
-                for col in selected_columns:
-                    val = row[col]
-                    if val is None:
-                        values.append('NULL')
-                    elif isinstance(val, (int, float)):
-                        values.append(str(val))
-                    else:
-                        val = str(val).replace("'", "''").replace('"', '\\"')
-                        values.append(f"'{val}'")
-                values_list.append(f"({', '.join(values)})")
-            
-            # Write batch query to file
-            batch_query = base_query + ',\n'.join(values_list) + ";"
-            temp_sql_file.write(batch_query + "\n-- Next batch --\n")
-            
-            # Update progress
-            progress = (batch_num + 1) / total_batches
-            progress_bar.progress(progress)
-            status_text.text(f"Processing batch {batch_num + 1} of {total_batches}")
-        
-        temp_sql_file.close()
-        
-        # Read generated queries
-        with open(temp_sql, 'r', encoding='utf-8') as f:
-            queries = f.read()
-        
-        return queries                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                 
-    
-    except Exception as e:
-        st.error(f"Error generating INSERT queries: {str(e)}")
-        return None
-    finally:
-        # Clean up temp files
-        try:
-            if temp_json and os.path.exists(temp_json):
-                os.remove(temp_json)
-            if temp_sql and os.path.exists(temp_sql):
-                os.remove(temp_sql)
-        except:
-            pass
+        with open(path, 'w', encoding='utf-8') as f:
+            for batch_num, statement in enumerate(statements):
+                if first_statement is None:
+                    first_statement = statement
+                f.write(statement + "\n-- Next batch --\n")
+                
+                # Update progress
+                progress_bar.progress((batch_num + 1) / total_batches)
+                status_text.text(f"Processing batch {batch_num + 1} of {total_batches}")
+    except BaseException:
+        store.discard(path)
+        raise
+    return store.commit(path, file_name), first_statement
 
-def generate_delete_query(table_name, column, results):
+def delete_keys(results, column):
+    """Distinct non-null values of `column`, in first-seen order"""
+    return pc.unique(results.table.column(column)).drop_null().to_pylist()
+
+def generate_delete_query(table_name, column, results, batch_size=DELETE_BATCH_ROWS):
+    """DELETE script for the distinct values of `column`, `batch_size` keys per statement"""
     if not results or not column or not table_name:
         return None
-    
-    values = [f'"{str(row[column])}"' for row in results]
-    values_str = ', '.join(values)
-    return f"DELETE FROM {table_name} WHERE {column} IN ({values_str});"
 
-def execute_insert_delete_query(conn, query):
-    if not conn:
-        st.warning('Please connect to a database first.')
-        return False
-    
-    try:
-        cursor = conn.cursor()
-        cursor.execute(query)
-        conn.commit()
-        affected_rows = cursor.rowcount
-        cursor.close()
-        return affected_rows
-    except mysql.connector.Error as err:
-        st.error(f"Error executing query: {err}")
-        return False
+    keys = pc.unique(results.table.column(column)).drop_null()
+    if not len(keys):
+        return None
+    formatter = sql_literal_formatters(pa.schema([pa.field(column, keys.type)]))[0]
+    literals = format_literal_column(formatter, keys).combine_chunks()
+    prefix = f"DELETE FROM {quote_table_name(table_name)} WHERE {quote_identifier(column)} IN ("
+    return '\n'.join(
+        prefix + ', '.join(literals.slice(offset, batch_size).to_pylist()) + ");"
+        for offset in range(0, len(literals), batch_size)
+    )
 
 def main():
     st.set_page_config(page_title="Export Code", layout="wide")
@@ -214,8 +1110,8 @@ def main():
         st.session_state['connections'] = []
     if 'company_queries' not in st.session_state:
         st.session_state['company_queries'] = {}
-    if 'db_connection' not in st.session_state:
-        st.session_state['db_connection'] = None
+    if 'db_profile' not in st.session_state:
+        st.session_state['db_profile'] = None
     if 'query_results' not in st.session_state:
         st.session_state['query_results'] = None
 
@@ -251,10 +1147,30 @@ def main():
                     password = st.text_input("Password", value=conn_details['password'], type="password")
 
                 if st.button("Connect to Database"):
-                    st.session_state['db_connection'] = connect_to_database(host, user, password, database)
-                    if st.session_state['db_connection']:
+                    st.session_state['db_profile'] = connect_to_database(host, user, password, database)
+                    if st.session_state['db_profile']:
                         st.success("Connected to database successfully!")
 
+        pool_stats = get_connection_pool().stats()
+        if pool_stats:
+            with st.expander("🔌 Connection pool"):
+                st.dataframe(pd.DataFrame([
+                    {
+                        'host': key[0],
+                        'user': key[1],
+                        'database': key[2],
+                        'in_use': stats['in_use'],
+                        'idle': stats['idle'],
+                        'checkouts': stats['checkouts'],
+                        'created': stats['created'],
+                        'reused': stats['reused'],
+                        'discarded': stats['discarded'],
+                        'avg_wait_ms': round(stats['wait_seconds'] * 1000 / max(stats['checkouts'], 1), 1),
+                        'max_wait_ms': round(stats['max_wait_seconds'] * 1000, 1),
+                    }
+                    for key, stats in pool_stats.items()
+                ]), use_container_width=True)
+
     with tab2:
         st.subheader("Query Execution")
         
@@ -276,16 +1192,22 @@ def main():
         else:
             query = st.text_area("SQL Query", height=150)
 
+        bypass_cache = st.checkbox("Bypass cache (always re-run the query)", key="query_bypass_cache")
+
         if st.button("Execute Query"):
-            if st.session_state['db_connection'] and query:
-                results = execute_query(st.session_state['db_connection'], query)
+            if st.session_state['db_profile'] and query:
+                results = fetch_results(st.session_state['db_profile'], query, bypass_cache=bypass_cache)
                 if results:
                     st.session_state['query_results'] = results
-                    st.dataframe(pd.DataFrame(results))
                     st.success(f"Query executed successfully! {len(results)} rows returned.")
                 else:
                     st.warning("No results returned from query.")
 
+        if st.session_state['query_results']:
+            render_result_preview(st.session_state['query_results'], key="query_preview_page")
+
+        render_query_cache_stats()
+
     with tab3:
         st.subheader("Insert/Delete Query Generation")
         
@@ -301,7 +1223,7 @@ def main():
             
             # Column selection for INSERT/DELETE
             if st.session_state['query_results']:
-                columns = list(st.session_state['query_results'][0].keys())
+                columns = st.session_state['query_results'].columns
                 
                 col1, col2 = st.columns(2)
                 
@@ -312,55 +1234,73 @@ def main():
                     
                     if st.button("Generate INSERT Query"):
                         if target_table and selected_columns:
-                            st.info("Generating INSERT queries... This may take a while for large datasets.")
-                            insert_queries = generate_insert_query_batched(
-                                target_table, 
-                                selected_columns, 
-                                st.session_state['query_results'],
-                                batch_size=batch_size
-                            )
-                            if insert_queries:
-                                st.download_button(
-                                    "Download INSERT Queries",
-                                    insert_queries,
-                                    file_name="insert_queries.sql",
-                                    mime="text/plain"
+                            try:
+                                statements = generate_insert_query_batched(
+                                    target_table, 
+                                    selected_columns, 
+                                    st.session_state['query_results'],
+                                    batch_size=batch_size
                                 )
-                                st.text_area("Preview of Generated INSERT Queries", 
-                                           insert_queries[:1000] + "...", 
-                                           height=200)
+                                total_batches = math.ceil(len(st.session_state['query_results']) / batch_size)
+                                artifact, first_statement = write_sql_artifact(statements, "insert_queries.sql", total_batches)
+                                remember_export(artifact)
+                                render_artifact_download(artifact, "Download INSERT Queries", key="download_insert_queries")
+                                if first_statement:
+                                    st.text_area("Preview of Generated INSERT Queries (first batch)", 
+                                               first_statement[:1000] + "...", 
+                                               height=200)
+                            except Exception as e:
+                                st.error(f"Error generating INSERT queries: {str(e)}")
+                    
+                    # Copy trực tiếp sang database đích, không qua file .sql
+                    ignore_duplicates = st.checkbox("INSERT IGNORE (bỏ qua dòng trùng khóa)", key="bulk_copy_ignore")
+                    if st.button("🚚 Copy vào Target Database"):
+                        if not st.session_state['connections'] or target_db == 'Select target database':
+                            st.error("Please select a target database")
+                        elif not target_table or not selected_columns:
+                            st.error("Please enter a target table and select columns")
+                        else:
+                            target_profile = st.session_state['connections'][connection_names.index(target_db)]
+                            submit_bulk_copy_job(target_profile, target_table,
+                                                 st.session_state['query_results'].table.select(list(selected_columns)),
+                                                 batch_size, ignore_duplicates)
                 
                 with col2:
                     st.subheader("DELETE Query")
                     delete_column = st.selectbox("Select Column for DELETE condition", columns)
                     
+                    delete_batch_size = st.number_input("Số key mỗi câu DELETE", min_value=1, value=DELETE_BATCH_ROWS, step=500)
+
                     if st.button("Generate DELETE Query"):
                         if target_table and delete_column:
                             delete_query = generate_delete_query(target_table, delete_column, 
-                                                              st.session_state['query_results'])
+                                                              st.session_state['query_results'],
+                                                              batch_size=delete_batch_size)
                             if delete_query:
-                                st.text_area("Generated DELETE Query", delete_query, height=200)
+                                st.text_area("Generated DELETE Query", delete_query[:10000], height=200)
                                 st.download_button(
                                     "Tải xuống câu lệnh DELETE",
                                     delete_query,
                                     file_name=f"{target_table}_delete_query.sql",
                                     mime="text/plain"
                                 )
-                                if st.button("Execute DELETE"):
-                                    if target_db != 'Select target database':
-                                        idx = connection_names.index(target_db)
-                                        target_conn_details = st.session_state['connections'][idx]
-                                        target_conn = connect_to_database(
-                                            target_conn_details['host'],
-                                            target_conn_details['user'],
-                                            target_conn_details['password'],
-                                            target_conn_details['database']
-                                        )
-                                        if target_conn:
-                                            affected_rows = execute_insert_delete_query(target_conn, delete_query)
-                                            if affected_rows:
-                                                st.success(f"Successfully deleted {affected_rows} rows!")
-                                            target_conn.close()
+
+                    # Xóa theo batch có tham số, mỗi batch một transaction
+                    delete_pause_ms = st.number_input("Nghỉ giữa các batch (ms)", min_value=0, value=0, step=100)
+                    if not st.session_state['connections'] or target_db == 'Select target database':
+                        st.info("Chọn Target Database để xóa trực tiếp")
+                    elif not target_table or not delete_column:
+                        st.info("Nhập Target Table và chọn cột để xóa trực tiếp")
+                    else:
+                        # Xem trước phạm vi xóa và bắt nhập lại tên bảng trước khi chạy
+                        target_profile = st.session_state['connections'][connection_names.index(target_db)]
+                        keys = delete_keys(st.session_state['query_results'], delete_column)
+                        st.warning(f"⚠️ Sẽ xóa khỏi `{target_profile['database']}.{target_table}` mọi dòng có "
+                                   f"`{delete_column}` thuộc {len(keys):,} giá trị khác nhau của kết quả truy vấn.")
+                        confirm_table = st.text_input("Nhập lại tên bảng đích để xác nhận", key="delete_confirm_table")
+                        if st.button("Execute DELETE", disabled=not keys or confirm_table.strip() != target_table):
+                            submit_chunked_delete_job(target_profile, target_table, delete_column, keys,
+                                                      delete_batch_size, delete_pause_ms / 1000)
 
     with tab4:
         st.subheader("Export Options")
@@ -373,84 +1313,28 @@ def main():
                 rows_per_file = st.number_input("Rows per File", min_value=1, value=9000)
                 double_row = st.checkbox("Export double rows")
                 include_headers = st.checkbox("Include column headers", value=True)
+                parallel_export = st.checkbox("⚡ Parallel export (use all CPU cores)", value=True, key="parallel_export")
 
             with col2:
                 if st.session_state['query_results']:
-                    columns = list(st.session_state['query_results'][0].keys())
+                    columns = st.session_state['query_results'].columns
                     qr_column = st.selectbox("QR Code Column", columns)
                     image_name_column = st.selectbox("Image Name Column", columns)
-                    qr_format = st.selectbox("QR Code Format", ["png", "jpg", "svg"])
+                    qr_formats = st.multiselect("QR Code Formats", ["png", "jpg", "svg"], default=["png"])
 
             # Export buttons
             col3, col4 = st.columns(2)
             with col3:
                 if st.button("Export to Excel"):
                     try:
-                        temp_dir = tempfile.mkdtemp()
-                        progress_bar = st.progress(0)
-                        status_text = st.empty()
-                        
-                        total_rows = len(st.session_state['query_results'])
-                        chunks = [st.session_state['query_results'][i:i + rows_per_file] 
-                                for i in range(0, total_rows, rows_per_file)]
-                        
-                        # Create a zip file to store all Excel files
-                        zip_path = os.path.join(temp_dir, f"{file_prefix}_excel_files.zip")
-                        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                            for i, chunk in enumerate(chunks):
-                                file_name = f'{file_prefix}-{i+1:03d}.xlsx'
-                                file_path = os.path.join(temp_dir, file_name)
-                                
-                                wb = openpyxl.Workbook()
-                                ws = wb.active
-                                
-                                headers = list(chunk[0].keys())
-                                row_num = 1
-                                
-                                # Write headers only if include_headers is True
-                                if include_headers:
-                                    for col, header in enumerate(headers, 1):
-                                        cell = ws.cell(row=1, column=col, value=header)
-                                        cell.font = Font(bold=True)
-                                        cell.alignment = Alignment(horizontal='center')
-                                    row_num = 2
-                                
-                                # Write data
-                                for record in chunk:
-                                    for col, key in enumerate(headers, 1):
-                                        ws.cell(row=row_num, column=col, value=str(record[key]))
-                                    if double_row:
-                                        row_num += 1
-                                        for col, key in enumerate(headers, 1):
-                                            ws.cell(row=row_num, column=col, value=str(record[key]))
-                                    row_num += 1
-                                
-                                wb.save(file_path)
-                                
-                                # Add Excel file to zip
-                                zipf.write(file_path, file_name)
-                                
-                                progress = (i + 1) / len(chunks)
-                                progress_bar.progress(progress)
-                                status_text.text(f"Processing file {i+1} of {len(chunks)}")
+                        tasks = chunk_file_tasks(st.session_state['query_results'], 'xlsx', file_prefix, rows_per_file,
+                                                 {'include_headers': include_headers, 'double_row': double_row})
                         
-                        # Create download button for zip file
-                        with open(zip_path, 'rb') as f:
-                            zip_contents = f.read()
-                            st.download_button(
-                                "Download All Excel Files (ZIP)",
-                                zip_contents,
-                                file_name=f"{file_prefix}_excel_files.zip",
-                                mime="application/zip"
-                            )
-                        
-                        st.success("Excel export completed successfully!")
+                        # Build the Excel ZIP in the background
+                        submit_export_job(f"Excel: {file_prefix}", run_file_export, f"{file_prefix}_excel_files.zip",
+                                          tasks, parallel=parallel_export)
                     except Exception as e:
                         st.error(f"Error during export: {str(e)}")
-                    finally:
-                        # Clean up temporary directory
-                        import shutil
-                        shutil.rmtree(temp_dir, ignore_errors=True)
 
             with col4:
                 col4_1, col4_2, col4_3 = st.columns(3)
@@ -464,242 +1348,42 @@ def main():
                             st.error("Please enter a table name")
                         else:
                             try:
-                                temp_dir = tempfile.mkdtemp()
-                                progress_bar = st.progress(0)
-                                status_text = st.empty()
-                                
-                                total_rows = len(st.session_state['query_results'])
-                                chunks = [st.session_state['query_results'][i:i + rows_per_file] 
-                                        for i in range(0, total_rows, rows_per_file)]
-                                
-                                # Create a zip file to store all SQL files
-                                zip_path = os.path.join(temp_dir, f"{file_prefix}_sql_files.zip")
-                                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                                    for i, chunk in enumerate(chunks):
-                                        if not chunk:
-                                            continue
-                                            
-                                        file_name = f'{file_prefix}-{i+1:03d}.sql'
-                                        file_path = os.path.join(temp_dir, file_name)
-                                        
-                                        try:
-                                            # Get column names from first row
-                                            columns = list(chunk[0].keys())
-                                            columns_str = ', '.join(f"`{col}`" for col in columns)
-                                            
-                                            # Write INSERT statements
-                                            values_list = []
-                                            for record in chunk:
-                                                values = []
-                                                for col in columns:
-                                                    val = record[col]
-                                                    if val is None:
-                                                        values.append('NULL')
-                                                    elif isinstance(val, (int, float)):
-                                                        values.append(str(val))
-                                                    else:
-                                                        # Properly escape string values
-                                                        val = str(val).replace('\\', '\\\\').replace("'", "\\'").replace('"', '\\"')
-                                                        values.append(f"'{val}'")
-                                                values_list.append(f"({', '.join(values)})")
-                                            
-                                            # Write all values in one INSERT statement with proper formatting
-                                            insert_query = f"INSERT INTO `{sql_table_name}` ({columns_str}) VALUES\n"
-                                            insert_query += ',\n'.join(values_list) + ";\n"
-                                            
-                                            # Write to file
-                                            with open(file_path, 'w', encoding='utf-8') as f:
-                                                f.write(insert_query)
-                                                if double_row:
-                                                    f.write(insert_query)
-                                            
-                                            # Add the SQL file to the zip
-                                            zipf.write(file_path, file_name)
-                                            
-                                        except Exception as e:
-                                            st.error(f"Error generating SQL for chunk {i+1}: {str(e)}")
-                                            continue
-                                        
-                                        # Update progress
-                                        progress = (i + 1) / len(chunks)
-                                        progress_bar.progress(progress)
-                                        status_text.text(f"Processing file {i+1} of {len(chunks)}")
+                                tasks = chunk_file_tasks(st.session_state['query_results'], 'sql', file_prefix, rows_per_file,
+                                                         {'sql_table_name': sql_table_name, 'double_row': double_row})
                                 
-                                # Create download button for zip file
-                                with open(zip_path, 'rb') as f:
-                                    zip_contents = f.read()
-                                    st.download_button(
-                                        "Download All SQL Files (ZIP)",
-                                        zip_contents,
-                                        file_name=f"{file_prefix}_sql_files.zip",
-                                        mime="application/zip"
-                                    )
-                                
-                                st.success("SQL export completed successfully!")
+                                # Build the SQL ZIP in the background
+                                submit_export_job(f"SQL: {file_prefix}", run_file_export, f"{file_prefix}_sql_files.zip",
+                                                  tasks, parallel=parallel_export)
                             except Exception as e:
                                 st.error(f"Error during SQL export: {str(e)}")
-                            finally:
-                                # Clean up temporary directory
-                                import shutil
-                                shutil.rmtree(temp_dir, ignore_errors=True)
                 
                 with col4_2:
                     if st.button("Export to TXT"):
                         try:
-                            temp_dir = tempfile.mkdtemp()
-                            progress_bar = st.progress(0)
-                            status_text = st.empty()
-                            
-                            total_rows = len(st.session_state['query_results'])
-                            chunks = [st.session_state['query_results'][i:i + rows_per_file] 
-                                    for i in range(0, total_rows, rows_per_file)]
-                            
-                            # Create a zip file to store all TXT files
-                            zip_path = os.path.join(temp_dir, f"{file_prefix}_txt_files.zip")
-                            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                                for i, chunk in enumerate(chunks):
-                                    file_name = f'{file_prefix}-{i+1:03d}.txt'
-                                    file_path = os.path.join(temp_dir, file_name)
-                                    
-                                    with open(file_path, 'w', encoding='utf-8', newline='') as txtfile:
-                                        headers = list(chunk[0].keys())
-                                        
-                                        # Write headers if include_headers is True
-                                        if include_headers:
-                                            txtfile.write(','.join(headers) + '\n')
-                                        
-                                        # Write data with actual values separated by commas
-                                        for record in chunk:
-                                            row_data = []
-                                            for key in headers:
-                                                value = record[key]
-                                                if value is None:
-                                                    row_data.append('')
-                                                else:
-                                                    # Convert to string and handle special characters
-                                                    str_value = str(value).replace('\n', ' ').replace('\r', ' ')
-                                                    # Escape commas in data by wrapping in quotes
-                                                    if ',' in str_value:
-                                                        str_value = f'"{str_value}"'
-                                                    row_data.append(str_value)
-                                            
-                                            data_line = ','.join(row_data)
-                                            txtfile.write(data_line + '\n')
-                                            
-                                            # Write double row if option is selected
-                                            if double_row:
-                                                txtfile.write(data_line + '\n')
-                                    
-                                    # Add TXT file to zip
-                                    zipf.write(file_path, file_name)
-                                    
-                                    progress = (i + 1) / len(chunks)
-                                    progress_bar.progress(progress)
-                                    status_text.text(f"Processing file {i+1} of {len(chunks)}")
-                            
-                            # Create download button for zip file
-                            with open(zip_path, 'rb') as f:
-                                zip_contents = f.read()
-                                st.download_button(
-                                    "Download All TXT Files (ZIP)",
-                                    zip_contents,
-                                    file_name=f"{file_prefix}_txt_files.zip",
-                                    mime="application/zip"
-                                )
+                            tasks = chunk_file_tasks(st.session_state['query_results'], 'txt', file_prefix, rows_per_file,
+                                                     {'include_headers': include_headers, 'double_row': double_row})
                             
-                            st.success("TXT export completed successfully!")
+                            # Build the TXT ZIP in the background
+                            submit_export_job(f"TXT: {file_prefix}", run_file_export, f"{file_prefix}_txt_files.zip",
+                                              tasks, parallel=parallel_export)
                         except Exception as e:
                             st.error(f"Error during TXT export: {str(e)}")
-                        finally:
-                            # Clean up temporary directory
-                            import shutil
-                            shutil.rmtree(temp_dir, ignore_errors=True)
                 
                 with col4_3:
-                    if st.button("Export QR Codes"):
+                    if st.button("Export QR Codes", disabled=not qr_formats):
                         try:
-                            temp_dir = tempfile.mkdtemp()
-                            progress_bar = st.progress(0)
-                            status_text = st.empty()
-                            
-                            # Create a zip file for QR codes
-                            zip_path = os.path.join(temp_dir, f"{file_prefix}_qr_codes.zip")
-                            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                                total = len(st.session_state['query_results'])
-                                for i, record in enumerate(st.session_state['query_results']):
-                                    qr_data = str(record[qr_column])
-                                    
-                                    # Clean filename - remove invalid characters
-                                    raw_name = str(record[image_name_column])
-                                    # Replace newlines, tabs, and other control characters with space
-                                    clean_name = raw_name.replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
-                                    # Remove invalid Windows filename characters
-                                    invalid_chars = '<>:"/\\|?*'
-                                    for char in invalid_chars:
-                                        clean_name = clean_name.replace(char, '_')
-                                    # Remove leading/trailing spaces and dots
-                                    clean_name = clean_name.strip('. ')
-                                    # Limit filename length (Windows has 255 char limit)
-                                    if len(clean_name) > 200:
-                                        clean_name = clean_name[:200]
-                                    # Ensure filename is not empty
-                                    if not clean_name:
-                                        clean_name = f"qr_code_{i+1}"
-                                    
-                                    image_name = f"{clean_name}.{qr_format}"
-                                    file_path = os.path.join(temp_dir, image_name)
-                                    
-                                    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-                                    qr.add_data(qr_data)
-                                    qr.make(fit=True)
-                                    
-                                    # Save based on format
-                                    if qr_format == 'svg':
-                                        # For SVG, use the make_image with factory
-                                        factory = qrcode.image.svg.SvgPathImage
-                                        qr_svg = qrcode.QRCode(
-                                            version=1,
-                                            box_size=10,
-                                            border=5,
-                                            image_factory=factory
-                                        )
-                                        qr_svg.add_data(qr_data)
-                                        qr_svg.make(fit=True)
-                                        img_svg = qr_svg.make_image(fill_color="black", back_color="white")
-                                        img_svg.save(file_path)
-                                    elif qr_format == 'png':
-                                        img = qr.make_image(fill_color="black", back_color="white")
-                                        img.save(file_path, format='PNG')
-                                    elif qr_format == 'jpg':
-                                        # Convert to RGB mode for JPEG (no transparency)
-                                        img = qr.make_image(fill_color="black", back_color="white")
-                                        img_rgb = img.convert('RGB')
-                                        img_rgb.save(file_path, format='JPEG', quality=95)
-                                    
-                                    # Add QR code to zip
-                                    zipf.write(file_path, image_name)
-                                    
-                                    progress = (i + 1) / total
-                                    progress_bar.progress(progress)
-                                    status_text.text(f"Processing QR code {i+1} of {total}")
-                            
-                            # Create download button for zip file
-                            with open(zip_path, 'rb') as f:
-                                zip_contents = f.read()
-                                st.download_button(
-                                    "Download QR Codes (ZIP)",
-                                    zip_contents,
-                                    file_name=f"{file_prefix}_qr_codes.zip",
-                                    mime="application/zip"
-                                )
+                            total = len(st.session_state['query_results'])
+                            qr_rows = st.session_state['query_results'].iter_rows([qr_column, image_name_column])
+                            # Lazy generator: rows are read inside the job thread
+                            qr_items = (
+                                (i, clean_image_name(name_value, f'qr_code_{i+1}'), str(qr_value))
+                                for i, (qr_value, name_value) in enumerate(qr_rows)
+                            )
                             
-                            st.success("QR codes exported successfully!")
+                            submit_export_job(f"QR: {file_prefix}", run_qr_export, f"{file_prefix}_qr_codes.zip",
+                                              qr_items, total, qr_formats, 10, 5, parallel=parallel_export)
                         except Exception as e:
                             st.error(f"Error during QR code export: {str(e)}")
-                        finally:
-                            # Clean up temporary directory
-                            import shutil
-                            shutil.rmtree(temp_dir, ignore_errors=True)
 
     # Initialize batch results in session state
     if 'batch_results' not in st.session_state:
@@ -720,11 +1404,13 @@ def main():
             placeholder="Ví dụ:\nSELECT id, CONCAT('http://sh.vinachg.vn/ck/?s=', `serial_rand`) AS `qrcode`, `serial` FROM stamp_sh WHERE stamp_block_id = 2870 ORDER BY `serial` ASC\nSELECT id, CONCAT('http://sh.vinachg.vn/ck/?s=', `serial_rand`) AS `qrcode`, `serial` FROM stamp_sh WHERE stamp_block_id = 2871 ORDER BY `serial` ASC"
         )
         
+        batch_bypass_cache = st.checkbox("⚡ Bỏ qua cache (luôn truy vấn lại database)", key="batch_bypass_cache")
+        
         col_exec1, col_exec2 = st.columns([4, 1])
         
         with col_exec1:
             if st.button("🔍 Thực thi và Xem Kết quả", key="batch_execute", type="primary"):
-                if not st.session_state['db_connection']:
+                if not st.session_state['db_profile']:
                     st.error("❌ Vui lòng kết nối database trước!")
                 elif not batch_queries_input.strip():
                     st.error("❌ Vui lòng nhập ít nhất một lệnh SQL!")
@@ -747,26 +1433,59 @@ def main():
                             
                             overall_progress = st.progress(0)
                             overall_status = st.empty()
+                            overall_status.text(f"⏳ Đang thực thi {len(queries_list)} lệnh song song...")
                             
-                            # Execute all queries and store results
+                            # Execute all queries concurrently, each on its own pooled connection
+                            outcomes = [None] * len(queries_list)
+                            batch_started = time.perf_counter()
+                            max_workers = max(1, min(BATCH_QUERY_WORKERS, POOL_MAX_SIZE, len(queries_list)))
+                            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                                futures = {
+                                    executor.submit(run_batch_query, st.session_state['db_profile'], query_info['query'], batch_bypass_cache): idx
+                                    for idx, query_info in enumerate(queries_list)
+                                }
+                                for done, future in enumerate(as_completed(futures), 1):
+                                    idx = futures[future]
+                                    outcome = future.result()
+                                    outcomes[idx] = outcome
+                                    
+                                    if outcome['error']:
+                                        st.error(f"❌ Lệnh {idx + 1}: {outcome['error']}")
+                                    elif outcome['results']:
+                                        st.success(f"✅ Lệnh {idx + 1}: {len(outcome['results'])} dòng ({outcome['elapsed']:.2f}s)")
+                                    else:
+                                        st.warning(f"⚠️ Lệnh {idx + 1}: Không có kết quả")
+                                    
+                                    overall_progress.progress(done / len(queries_list))
+                                    overall_status.text(f"⏳ Đã hoàn thành {done}/{len(queries_list)} lệnh")
+                            batch_elapsed = time.perf_counter() - batch_started
+                            
+                            # Keep the original query order
                             all_results = []
-                            for idx, query_info in enumerate(queries_list):
-                                overall_status.text(f"⏳ Đang thực thi lệnh {idx + 1}/{len(queries_list)}")
-                                
-                                results = execute_query(st.session_state['db_connection'], query_info['query'])
-                                
-                                if results:
+                            for query_info, outcome in zip(queries_list, outcomes):
+                                if outcome['results']:
                                     all_results.append({
                                         'query': query_info['query'],
-                                        'results': results,
-                                        'row_count': len(results),
-                                        'index': query_info['index']
+                                        'results': outcome['results'],
+                                        'row_count': len(outcome['results']),
+                                        'index': query_info['index'],
+                                        'elapsed': outcome['elapsed']
                                     })
-                                    st.success(f"✅ Lệnh {idx + 1}: {len(results)} dòng")
-                                else:
-                                    st.warning(f"⚠️ Lệnh {idx + 1}: Không có kết quả")
-                                
-                                overall_progress.progress((idx + 1) / len(queries_list))
+                            
+                            with st.expander("⏱️ Thời gian thực thi từng lệnh"):
+                                st.dataframe(pd.DataFrame([
+                                    {
+                                        'Lệnh': idx + 1,
+                                        'Dòng SQL': query_info['index'],
+                                        'Số dòng': len(outcome['results']) if outcome['results'] else 0,
+                                        'Thời gian (s)': round(outcome['elapsed'], 3),
+                                        'Cache': '⚡' if outcome['from_cache'] else '',
+                                        'Lỗi': outcome['error'] or ''
+                                    }
+                                    for idx, (query_info, outcome) in enumerate(zip(queries_list, outcomes))
+                                ]), use_container_width=True)
+                                total_query_time = sum(outcome['elapsed'] for outcome in outcomes)
+                                st.caption(f"Tổng thời gian: {batch_elapsed:.2f}s (tổng thời gian các lệnh: {total_query_time:.2f}s, {max_workers} kết nối song song)")
                             
                             if not all_results:
                                 st.error("❌ Không có kết quả nào từ các lệnh SQL!")
@@ -799,7 +1518,7 @@ def main():
                 with st.expander(f"📊 Bảng {idx + 1} - Lệnh SQL #{result_info['index']} ({result_info['row_count']} dòng)", expanded=True):
                     # Display query and preview
                     st.code(result_info['query'], language='sql')
-                    st.dataframe(pd.DataFrame(result_info['results']).head(10), use_container_width=True)
+                    st.dataframe(result_info['results'].head(10), use_container_width=True)
                     if result_info['row_count'] > 10:
                         st.caption(f"Hiển thị 10/{result_info['row_count']} dòng đầu tiên")
                     
@@ -860,6 +1579,8 @@ def main():
             if batch_export_format == "SQL (.sql)":
                 batch_sql_table = st.text_input("Tên bảng SQL (dùng chung cho tất cả)", key="batch_sql_table")
             
+            batch_parallel_export = st.checkbox("⚡ Xuất song song (dùng tất cả CPU)", value=True, key="batch_parallel_export")
+            
             # Export button
             if st.button("📥 Xuất tất cả file", key="export_batch", type="primary"):
                 # Validate configurations
@@ -873,182 +1594,31 @@ def main():
                     st.error("❌ Vui lòng nhập tên bảng SQL!")
                 else:
                     try:
-                        temp_dir = tempfile.mkdtemp()
-                        overall_status = st.empty()
+                        batch_format_ext = {"Excel (.xlsx)": 'xlsx', "TXT (.txt)": 'txt', "SQL (.sql)": 'sql'}[batch_export_format]
                         
-                        # Export based on format
-                        overall_status.text(f"📦 Đang tạo file xuất...")
-                        zip_path = os.path.join(temp_dir, f"{batch_file_prefix}_batch.zip")
+                        # One task per output file, across all tables, in table order
+                        tasks = []
+                        for idx, result_info in enumerate(st.session_state['batch_results']):
+                            # Get configuration for this table
+                            config = table_configs[idx]
+                            options = {
+                                'include_headers': config['include_headers'],
+                                'double_row': config['double_row'],
+                                'sql_table_name': batch_sql_table,
+                            }
+                            tasks.extend(chunk_file_tasks(result_info['results'], batch_format_ext, config['file_name'],
+                                                          config['rows_per_file'], options, numbered=False))
                         
-                        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                            export_progress = st.progress(0)
-                            export_status = st.empty()
-                            
-                            for idx, result_info in enumerate(st.session_state['batch_results']):
-                                # Get configuration for this table
-                                config = table_configs[idx]
-                                file_name = config['file_name']
-                                rows_per_file = config['rows_per_file']
-                                include_headers = config['include_headers']
-                                double_row = config['double_row']
-                                results = result_info['results']
-                                
-                                export_status.text(f"📝 Đang xuất file {idx + 1}/{len(st.session_state['batch_results'])}: {file_name}")
-                                
-                                if batch_export_format == "Excel (.xlsx)":
-                                    # Export to Excel
-                                    total_rows = len(results)
-                                    chunks = [results[i:i + rows_per_file] 
-                                            for i in range(0, total_rows, rows_per_file)]
-                                    
-                                    for chunk_idx, chunk in enumerate(chunks):
-                                        if len(chunks) > 1:
-                                            excel_file_name = f'{file_name}-{chunk_idx+1:03d}.xlsx'
-                                        else:
-                                            excel_file_name = f'{file_name}.xlsx'
-                                        
-                                        file_path = os.path.join(temp_dir, excel_file_name)
-                                        
-                                        wb = openpyxl.Workbook()
-                                        ws = wb.active
-                                        headers = list(chunk[0].keys())
-                                        row_num = 1
-                                        
-                                        if include_headers:
-                                            for col, header in enumerate(headers, 1):
-                                                cell = ws.cell(row=1, column=col, value=header)
-                                                cell.font = Font(bold=True)
-                                                cell.alignment = Alignment(horizontal='center')
-                                            row_num = 2
-                                        
-                                        for record in chunk:
-                                            for col, key in enumerate(headers, 1):
-                                                ws.cell(row=row_num, column=col, value=str(record[key]))
-                                            row_num += 1
-                                            
-                                            # Double row if enabled
-                                            if double_row:
-                                                for col, key in enumerate(headers, 1):
-                                                    ws.cell(row=row_num, column=col, value=str(record[key]))
-                                                row_num += 1
-                                        
-                                        wb.save(file_path)
-                                        zipf.write(file_path, excel_file_name)
-                                
-                                elif batch_export_format == "TXT (.txt)":
-                                    # Export to TXT
-                                    total_rows = len(results)
-                                    chunks = [results[i:i + rows_per_file] 
-                                            for i in range(0, total_rows, rows_per_file)]
-                                    
-                                    for chunk_idx, chunk in enumerate(chunks):
-                                        if len(chunks) > 1:
-                                            txt_file_name = f'{file_name}-{chunk_idx+1:03d}.txt'
-                                        else:
-                                            txt_file_name = f'{file_name}.txt'
-                                        
-                                        file_path = os.path.join(temp_dir, txt_file_name)
-                                        
-                                        with open(file_path, 'w', encoding='utf-8', newline='') as txtfile:
-                                            headers = list(chunk[0].keys())
-                                            
-                                            if include_headers:
-                                                txtfile.write(','.join(headers) + '\n')
-                                            
-                                            for record in chunk:
-                                                row_data = []
-                                                for key in headers:
-                                                    value = record[key]
-                                                    if value is None:
-                                                        row_data.append('')
-                                                    else:
-                                                        str_value = str(value).replace('\n', ' ').replace('\r', ' ')
-                                                        if ',' in str_value:
-                                                            str_value = f'"{str_value}"'
-                                                        row_data.append(str_value)
-                                                
-                                                data_line = ','.join(row_data)
-                                                txtfile.write(data_line + '\n')
-                                                
-                                                # Double row if enabled
-                                                if double_row:
-                                                    txtfile.write(data_line + '\n')
-                                        
-                                        zipf.write(file_path, txt_file_name)
-                                
-                                elif batch_export_format == "SQL (.sql)":
-                                    # Export to SQL
-                                    if not batch_sql_table:
-                                        st.error("❌ Vui lòng nhập tên bảng SQL!")
-                                        break
-                                    
-                                    total_rows = len(results)
-                                    chunks = [results[i:i + rows_per_file] 
-                                            for i in range(0, total_rows, rows_per_file)]
-                                    
-                                    for chunk_idx, chunk in enumerate(chunks):
-                                        if len(chunks) > 1:
-                                            sql_file_name = f'{file_name}-{chunk_idx+1:03d}.sql'
-                                        else:
-                                            sql_file_name = f'{file_name}.sql'
-                                        
-                                        file_path = os.path.join(temp_dir, sql_file_name)
-                                        
-                                        columns = list(chunk[0].keys())
-                                        columns_str = ', '.join(f"`{col}`" for col in columns)
-                                        
-                                        values_list = []
-                                        for record in chunk:
-                                            values = []
-                                            for col in columns:
-                                                val = record[col]
-                                                if val is None:
-                                                    values.append('NULL')
-                                                elif isinstance(val, (int, float)):
-                                                    values.append(str(val))
-                                                else:
-                                                    val = str(val).replace('\\', '\\\\').replace("'", "\\'").replace('"', '\\"')
-                                                    values.append(f"'{val}'")
-                                            
-                                            value_str = f"({', '.join(values)})"
-                                            values_list.append(value_str)
-                                            
-                                            # Double row if enabled
-                                            if double_row:
-                                                values_list.append(value_str)
-                                        
-                                        insert_query = f"INSERT INTO `{batch_sql_table}` ({columns_str}) VALUES\n"
-                                        insert_query += ',\n'.join(values_list) + ";\n"
-                                        
-                                        with open(file_path, 'w', encoding='utf-8') as f:
-                                            f.write(insert_query)
-                                        
-                                        zipf.write(file_path, sql_file_name)
-                                
-                                export_progress.progress((idx + 1) / len(st.session_state['batch_results']))
-                        
-                        # Provide download button
-                        with open(zip_path, 'rb') as f:
-                            zip_contents = f.read()
-                            st.download_button(
-                                "📥 Tải xuất tất cả các file (ZIP)",
-                                zip_contents,
-                                file_name=f"{batch_file_prefix}_batch.zip",
-                                mime="application/zip",
-                                key="download_batch"
-                            )
+                        submit_export_job(f"Batch: {batch_file_prefix}", run_file_export, f"{batch_file_prefix}_batch.zip",
+                                          tasks, parallel=batch_parallel_export)
                         
                         # Summary
-                        st.success(f"✅ Hoàn thành! Đã xuất {len(st.session_state['batch_results'])} file")
                         with st.expander("📊 Chi tiết kết quả"):
                             for idx, result_info in enumerate(st.session_state['batch_results']):
                                 config = table_configs[idx]
                                 st.write(f"**{config['file_name']}**: {result_info['row_count']} dòng")
                                 st.caption(f"   ├─ Rows per file: {config['rows_per_file']} | Headers: {'✓' if config['include_headers'] else '✗'} | Double row: {'✓' if config['double_row'] else '✗'}")
                         
-                        # Clean up
-                        import shutil
-                        shutil.rmtree(temp_dir, ignore_errors=True)
                         
                     except Exception as e:
                         st.error(f"❌ Lỗi trong quá trình xuất: {str(e)}")
@@ -1072,7 +1642,7 @@ def main():
         if uploaded_excel is not None:
             try:
                 # Read Excel file
-                df_excel = pd.read_excel(uploaded_excel)
+                df_excel = read_uploaded_frame(uploaded_excel, pd.read_excel)
                 
                 st.success(f"✅ Đã tải file thành công! Tìm thấy {len(df_excel)} dòng và {len(df_excel.columns)} cột")
                 
@@ -1098,10 +1668,12 @@ def main():
                     )
                     
                     # Select QR format
-                    qr_format_excel = st.selectbox(
+                    qr_formats_excel = st.multiselect(
                         "🖼️ Định dạng QR Code",
                         options=["png", "jpg", "svg"],
-                        key="excel_qr_format"
+                        default=["png"],
+                        key="excel_qr_format",
+                        help="Chọn nhiều định dạng: mỗi mã chỉ được mã hóa một lần"
                     )
                     
                     # QR Code size
@@ -1159,6 +1731,12 @@ def main():
                         key="add_index",
                         help="Thêm số thứ tự vào đầu tên file để tránh trùng lặp"
                     )
+                    
+                    excel_qr_parallel = st.checkbox(
+                        "⚡ Tạo QR song song (dùng tất cả CPU)",
+                        value=True,
+                        key="excel_qr_parallel"
+                    )
                 
                 # Preview selected data
                 st.markdown("### 👀 Xem trước dữ liệu sẽ tạo QR")
@@ -1168,134 +1746,46 @@ def main():
                 
                 # Generate QR Codes button
                 st.markdown("---")
-                if st.button("🎨 Tạo QR Code", key="generate_qr_from_excel", type="primary"):
+                if st.button("🎨 Tạo QR Code", key="generate_qr_from_excel", type="primary", disabled=not qr_formats_excel):
                     try:
-                        temp_dir = tempfile.mkdtemp()
-                        progress_bar = st.progress(0)
-                        status_text = st.empty()
+                        total_rows = len(df_excel)
+                        skip_count = 0
+                        qr_items = []
                         
-                        # Create zip file
-                        zip_path = os.path.join(temp_dir, f"{excel_qr_prefix}.zip")
-                        
-                        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                            total_rows = len(df_excel)
-                            success_count = 0
-                            skip_count = 0
-                            error_count = 0
+                        for idx, (qr_data, raw_filename) in enumerate(zip(df_excel[qr_data_column], df_excel[filename_column])):
+                            # Skip if empty and skip_empty is enabled
+                            if skip_empty and (pd.isna(qr_data) or str(qr_data).strip() == ''):
+                                skip_count += 1
+                                continue
                             
-                            for idx, row in df_excel.iterrows():
-                                try:
-                                    # Get QR data
-                                    qr_data = row[qr_data_column]
-                                    
-                                    # Skip if empty and skip_empty is enabled
-                                    if skip_empty and (pd.isna(qr_data) or str(qr_data).strip() == ''):
-                                        skip_count += 1
-                                        continue
-                                    
-                                    # Get filename
-                                    raw_filename = row[filename_column]
-                                    
-                                    # Skip if filename is empty
-                                    if pd.isna(raw_filename) or str(raw_filename).strip() == '':
-                                        if skip_empty:
-                                            skip_count += 1
-                                            continue
-                                        else:
-                                            raw_filename = f"qr_code_{idx + 1}"
-                                    
-                                    # Clean filename
-                                    clean_name = str(raw_filename).replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
-                                    invalid_chars = '<>:"/\\|?*'
-                                    for char in invalid_chars:
-                                        clean_name = clean_name.replace(char, '_')
-                                    clean_name = clean_name.strip('. ')
-                                    
-                                    # Limit filename length
-                                    if len(clean_name) > 200:
-                                        clean_name = clean_name[:200]
-                                    
-                                    # Ensure filename is not empty
-                                    if not clean_name:
-                                        clean_name = f"qr_code_{idx + 1}"
-                                    
-                                    # Add index if enabled
-                                    if add_index_to_filename:
-                                        clean_name = f"{idx + 1:05d}_{clean_name}"
-                                    
-                                    # Create full filename
-                                    image_name = f"{clean_name}.{qr_format_excel}"
-                                    file_path = os.path.join(temp_dir, image_name)
-                                    
-                                    # Generate QR code
-                                    qr = qrcode.QRCode(
-                                        version=1,
-                                        box_size=qr_box_size,
-                                        border=qr_border
-                                    )
-                                    qr.add_data(str(qr_data))
-                                    qr.make(fit=True)
-                                    
-                                    # Save based on format
-                                    if qr_format_excel == 'svg':
-                                        factory = qrcode.image.svg.SvgPathImage
-                                        qr_svg = qrcode.QRCode(
-                                            version=1,
-                                            box_size=qr_box_size,
-                                            border=qr_border,
-                                            image_factory=factory
-                                        )
-                                        qr_svg.add_data(str(qr_data))
-                                        qr_svg.make(fit=True)
-                                        img_svg = qr_svg.make_image(fill_color="black", back_color="white")
-                                        img_svg.save(file_path)
-                                    elif qr_format_excel == 'png':
-                                        img = qr.make_image(fill_color="black", back_color="white")
-                                        img.save(file_path, format='PNG')
-                                    elif qr_format_excel == 'jpg':
-                                        img = qr.make_image(fill_color="black", back_color="white")
-                                        img_rgb = img.convert('RGB')
-                                        img_rgb.save(file_path, format='JPEG', quality=95)
-                                    
-                                    # Add to zip
-                                    zipf.write(file_path, image_name)
-                                    success_count += 1
-                                    
-                                except Exception as e:
-                                    error_count += 1
-                                    st.warning(f"⚠️ Lỗi tại dòng {idx + 1}: {str(e)}")
-                                
-                                # Update progress
-                                progress = (idx + 1) / total_rows
-                                progress_bar.progress(progress)
-                                status_text.text(f"⏳ Đang xử lý: {idx + 1}/{total_rows} | Thành công: {success_count} | Bỏ qua: {skip_count} | Lỗi: {error_count}")
-                        
-                        # Provide download button
-                        if success_count > 0:
-                            with open(zip_path, 'rb') as f:
-                                zip_contents = f.read()
-                                st.download_button(
-                                    "📥 Tải xuống tất cả QR Code (ZIP)",
-                                    zip_contents,
-                                    file_name=f"{excel_qr_prefix}.zip",
-                                    mime="application/zip",
-                                    key="download_excel_qr"
-                                )
+                            # Skip if filename is empty
+                            if pd.isna(raw_filename) or str(raw_filename).strip() == '':
+                                if skip_empty:
+                                    skip_count += 1
+                                    continue
+                                else:
+                                    raw_filename = f"qr_code_{idx + 1}"
+                            
+                            clean_name = clean_image_name(raw_filename, f"qr_code_{idx + 1}")
+                            
+                            # Add index if enabled
+                            if add_index_to_filename:
+                                clean_name = f"{idx + 1:05d}_{clean_name}"
                             
-                            # Summary
-                            st.success(f"✅ Hoàn thành! Đã tạo {success_count} QR code")
+                            qr_items.append((idx, clean_name, str(qr_data)))
+                        
+                        if not qr_items:
+                            st.error("❌ Không tạo được QR code nào. Vui lòng kiểm tra lại dữ liệu!")
+                        else:
+                            # Render and zip in the background; progress and download in the sidebar
+                            submit_export_job(f"QR Excel: {excel_qr_prefix}", run_qr_export, f"{excel_qr_prefix}.zip",
+                                              qr_items, total_rows, qr_formats_excel, qr_box_size, qr_border,
+                                              parallel=excel_qr_parallel, skipped=skip_count)
                             
                             with st.expander("📊 Thống kê chi tiết"):
                                 st.write(f"**Tổng số dòng:** {total_rows}")
-                                st.write(f"**✅ Thành công:** {success_count}")
+                                st.write(f"**🎨 Sẽ tạo:** {len(qr_items)}")
                                 st.write(f"**⏭️ Bỏ qua:** {skip_count}")
-                                st.write(f"**❌ Lỗi:** {error_count}")
-                        else:
-                            st.error("❌ Không tạo được QR code nào. Vui lòng kiểm tra lại dữ liệu!")
-                        
-                        # Clean up
-                        import shutil
-                        shutil.rmtree(temp_dir, ignore_errors=True)
                         
                     except Exception as e:
                         st.error(f"❌ Lỗi trong quá trình tạo QR code: {str(e)}")
@@ -1327,7 +1817,7 @@ def main():
         if uploaded_lookup_file is not None:
             try:
                 # Read Excel file
-                df_lookup = pd.read_excel(uploaded_lookup_file)
+                df_lookup = read_uploaded_frame(uploaded_lookup_file, pd.read_excel)
                 
                 st.success(f"✅ Đã tải file thành công! Tìm thấy {len(df_lookup)} dòng và {len(df_lookup.columns)} cột")
                 
@@ -1358,185 +1848,170 @@ def main():
                     st.write("✓ qrcode")
                     st.write("✓ serial")
                     st.caption("Các cột mặc định từ bảng codes_evnhcm")
+
+                col_strategy, col_batch, col_workers = st.columns(3)
+                with col_strategy:
+                    lookup_strategy_options = {
+                        STRATEGY_AUTO: f"Tự động (bảng tạm từ {LOOKUP_TEMP_TABLE_MIN_KEYS:,} key)",
+                        STRATEGY_BATCHED: "Batch IN (...) song song",
+                        STRATEGY_TEMP_TABLE: "Bảng tạm + JOIN",
+                    }
+                    requested_strategy = st.selectbox(
+                        "🧭 Cách tra cứu", options=list(lookup_strategy_options),
+                        format_func=lookup_strategy_options.get, key="lookup_strategy"
+                    )
+                with col_batch:
+                    lookup_batch_size = st.number_input(
+                        "📦 Số key mỗi truy vấn", min_value=100, max_value=50000,
+                        value=LOOKUP_BATCH_SIZE, step=500, key="lookup_batch_size"
+                    )
+                with col_workers:
+                    lookup_workers = st.number_input(
+                        "⚡ Số truy vấn song song", min_value=1, max_value=POOL_MAX_SIZE,
+                        value=min(LOOKUP_WORKERS, POOL_MAX_SIZE), key="lookup_workers"
+                    )
+                
+                lookup_source_options = {
+                    'live': "Database",
+                    'index': "Index cục bộ",
+                    'index_fallback': "Index cục bộ, thiếu thì hỏi database",
+                    'verify': "Index cục bộ + đối chiếu database",
+                }
+                lookup_source = st.radio(
+                    "🗂️ Nguồn tra cứu", options=list(lookup_source_options),
+                    format_func=lookup_source_options.get, horizontal=True, key="lookup_source"
+                )
+                if st.session_state['db_profile']:
+                    code_index = get_code_index(code_index_path(connection_profile_key(st.session_state['db_profile'])))
+                    index_stats = code_index.stats()
+                    with st.expander(f"🗂️ Index cục bộ: {index_stats['rows']:,} mã"):
+                        if index_stats['refreshed']:
+                            refreshed = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(index_stats['refreshed']))
+                            st.caption(f"Đồng bộ lần cuối {refreshed} | tới id {index_stats['high_water']:,} | "
+                                       f"{index_stats['bytes'] / 1024 / 1024:.1f} MB")
+                        else:
+                            st.caption("Index chưa được đồng bộ lần nào")
+                        if st.button("🔄 Đồng bộ index (chỉ lấy mã mới)", key="refresh_code_index"):
+                            submit_code_index_refresh_job(st.session_state['db_profile'])
                 
                 # Preview selected data
                 st.markdown("### 👀 Xem trước dữ liệu sẽ tra cứu")
-                preview_lookup = df_lookup[[data_column]].head(10).copy()
-                
-                # Add column to show data type detection
-                def detect_type(value):
-                    if pd.isna(value):
-                        return "❓ Trống"
-                    str_value = str(value).strip()
-                    if str_value.isdigit():
-                        return "🔢 Serial"
-                    else:
-                        return "🔗 QR Code"
-                
-                def get_db_search_value(value):
-                    if pd.isna(value):
-                        return ""
-                    str_value = str(value).strip()
-                    if str_value.isdigit():
-                        return f"26.{str_value}"
-                    else:
-                        return str_value
-                
-                preview_lookup['Loại dữ liệu'] = df_lookup[data_column].head(10).apply(detect_type)
-                preview_lookup['Giá trị tìm trong DB'] = df_lookup[data_column].head(10).apply(get_db_search_value)
-                preview_lookup.columns = ['Dữ liệu gốc', 'Loại phát hiện', 'Tra cứu trong DB']
+                preview_classified = classify_lookup_values(df_lookup[data_column].head(10))
+                preview_lookup = pd.DataFrame({
+                    'Dữ liệu gốc': df_lookup[data_column].head(10).reset_index(drop=True),
+                    'Loại phát hiện': preview_classified['kind'].cat.rename_categories(KIND_LABELS),
+                    'Tra cứu trong DB': preview_classified['db_value'].fillna(''),
+                })
                 st.dataframe(preview_lookup, use_container_width=True)
                 st.caption("💡 Serial sẽ tự động thêm prefix '26.' khi tra cứu trong database")
                 
                 # Lookup button
                 st.markdown("---")
                 if st.button("🔎 Bắt đầu tra cứu", key="start_lookup", type="primary"):
-                    if not st.session_state['db_connection']:
+                    if not st.session_state['db_profile']:
                         st.error("❌ Vui lòng kết nối database trước!")
                     else:
                         try:
                             progress_bar = st.progress(0)
                             status_text = st.empty()
                             
-                            # Prepare data for lookup
-                            lookup_data = df_lookup[data_column].tolist()
-                            total_items = len(lookup_data)
-                            
-                            # Separate serials and qrcodes
-                            serials = []
-                            qrcodes = []
-                            data_map = {}  # Map to store original order
-                            
+                            # Phân loại vectorized; key trùng chỉ tra cứu một lần
                             status_text.text("🔄 Đang phân loại dữ liệu...")
+                            classified = classify_lookup_values(df_lookup[data_column])
+                            total_items = len(classified)
+                            kind_counts = classified['kind'].value_counts()
+                            keys_by_column = lookup_keys(classified)
+                            serials, qrcodes = keys_by_column['serial'], keys_by_column['qrcode']
                             
-                            for idx, value in enumerate(lookup_data):
-                                if pd.isna(value):
-                                    data_map[idx] = {'type': 'empty', 'value': value}
-                                    continue
-                                
-                                str_value = str(value).strip()
-                                if str_value.isdigit():
-                                    # Thêm prefix "26." vào trước serial để tìm trong database
-                                    serial_with_prefix = f"26.{str_value}"
-                                    serials.append(serial_with_prefix)
-                                    data_map[idx] = {'type': 'serial', 'value': str_value, 'db_value': serial_with_prefix}
-                                else:
-                                    qrcodes.append(str_value)
-                                    data_map[idx] = {'type': 'qrcode', 'value': str_value}
-                            
-                            st.info(f"📊 Phân loại: {len(serials)} serial, {len(qrcodes)} qrcode, {total_items - len(serials) - len(qrcodes)} trống")
+                            st.info(f"📊 Phân loại: {kind_counts['serial']} serial ({len(serials)} khác nhau), "
+                                    f"{kind_counts['qrcode']} qrcode ({len(qrcodes)} khác nhau), {kind_counts['empty']} trống")
                             
-                            # Query database
+                            # Tra cứu trên index cục bộ và/hoặc database
                             results_dict = {}
-                            
-                            # Query for serials
-                            if serials:
-                                status_text.text(f"🔍 Đang tra cứu {len(serials)} serial...")
-                                serials_str = "', '".join(serials)
-                                query_serial = f"SELECT `qrcode`, `serial` FROM codes_evnhcm WHERE `serial` IN ('{serials_str}')"
-                                
-                                serial_results = execute_query(st.session_state['db_connection'], query_serial)
-                                
-                                if serial_results:
-                                    for result in serial_results:
-                                        results_dict[result['serial']] = result
-                                    st.success(f"✅ Tìm thấy {len(serial_results)}/{len(serials)} serial trong database")
-                                else:
-                                    st.warning(f"⚠️ Không tìm thấy serial nào trong database")
-                            
-                            progress_bar.progress(0.5)
-                            
-                            # Query for qrcodes
-                            if qrcodes:
-                                status_text.text(f"🔍 Đang tra cứu {len(qrcodes)} qrcode...")
-                                qrcodes_str = "', '".join(qrcodes)
-                                query_qrcode = f"SELECT `qrcode`, `serial` FROM codes_evnhcm WHERE `qrcode` IN ('{qrcodes_str}')"
-                                
-                                qrcode_results = execute_query(st.session_state['db_connection'], query_qrcode)
-                                
-                                if qrcode_results:
-                                    for result in qrcode_results:
-                                        results_dict[result['qrcode']] = result
-                                    st.success(f"✅ Tìm thấy {len(qrcode_results)}/{len(qrcodes)} qrcode trong database")
+                            batch_stats = []
+                            profile = st.session_state['db_profile']
+                            lookup_started = time.perf_counter()
+
+                            def collect(outcomes, source, total, into):
+                                for done, outcome in enumerate(outcomes, 1):
+                                    for result in outcome['rows']:
+                                        into[result[outcome['column']]] = result
+                                    batch_stat = {
+                                        'Nguồn': source,
+                                        'Batch': outcome['batch'],
+                                        'Loại': outcome['column'],
+                                        'Số key': outcome['keys'],
+                                        'Tìm thấy': len(outcome['rows']),
+                                        'Thời gian (s)': round(outcome['seconds'], 3),
+                                    }
+                                    if 'load_seconds' in outcome:
+                                        batch_stat['Nạp bảng tạm (s)'] = round(outcome['load_seconds'], 3)
+                                    batch_stats.append(batch_stat)
+                                    progress_bar.progress(0.8 * done / total)
+                                    status_text.text(f"🔍 {source}: đã xong {done}/{total} batch")
+
+                            def live_lookup(keys_by_column, into):
+                                # Các batch IN (...) có tham số chạy song song, hoặc bảng tạm + JOIN khi rất nhiều key
+                                strategy = lookup_strategy(sum(len(keys) for keys in keys_by_column.values()), requested_strategy)
+                                total = lookup_batch_count(keys_by_column, lookup_batch_size, strategy)
+                                with ThreadPoolExecutor(max_workers=lookup_workers) as executor:
+                                    collect(iter_lookup_results(get_connection_pool(), profile, keys_by_column, executor,
+                                                                lookup_batch_size, strategy),
+                                            f"Database ({lookup_strategy_options[strategy]})", total, into)
+
+                            if lookup_source == 'live':
+                                live_lookup(keys_by_column, results_dict)
+                            else:
+                                code_index = get_code_index(code_index_path(connection_profile_key(profile)))
+                                collect(iter_index_lookups(code_index, keys_by_column), "Index cục bộ",
+                                        sum(1 for keys in keys_by_column.values() if keys), results_dict)
+                                if lookup_source == 'index_fallback':
+                                    # Mã mới thêm sau lần đồng bộ cuối chỉ có trên database
+                                    missing = {column: [key for key in keys if key not in results_dict]
+                                               for column, keys in keys_by_column.items()}
+                                    if any(missing.values()):
+                                        live_lookup(missing, results_dict)
+                                elif lookup_source == 'verify':
+                                    live_results = {}
+                                    live_lookup(keys_by_column, live_results)
+                                    mismatches = [
+                                        {'Key': key, 'Index cục bộ': str(results_dict.get(key)), 'Database': str(live_results.get(key))}
+                                        for key in set(results_dict) | set(live_results)
+                                        if results_dict.get(key) != live_results.get(key)
+                                    ]
+                                    if mismatches:
+                                        st.warning(f"⚠️ {len(mismatches)} key khác nhau giữa index cục bộ và database, dùng kết quả database")
+                                        st.dataframe(pd.DataFrame(mismatches[:100]), use_container_width=True, hide_index=True)
+                                    else:
+                                        st.success("✅ Index cục bộ khớp với database")
+                                    results_dict = live_results
+                            lookup_elapsed = time.perf_counter() - lookup_started
+
+                            for column, keys in keys_by_column.items():
+                                if not keys:
+                                    continue
+                                found = sum(1 for key in keys if key in results_dict)
+                                if found:
+                                    st.success(f"✅ Tìm thấy {found}/{len(keys)} {column} khác nhau")
                                 else:
-                                    st.warning(f"⚠️ Không tìm thấy qrcode nào trong database")
+                                    st.warning(f"⚠️ Không tìm thấy {column} nào")
+                            if batch_stats:
+                                with st.expander(f"⏱️ Thời gian từng batch ({len(batch_stats)} batch, tổng {lookup_elapsed:.2f}s)"):
+                                    st.dataframe(pd.DataFrame(batch_stats), use_container_width=True, hide_index=True)
                             
                             progress_bar.progress(0.8)
                             
-                            # Build results in original order
+                            # Ghép kết quả về đúng thứ tự dòng trong file
                             status_text.text("📝 Đang sắp xếp kết quả...")
-                            
-                            ordered_results = []
-                            found_count = 0
-                            not_found_count = 0
-                            
-                            for idx in range(total_items):
-                                item = data_map.get(idx, {})
-                                item_type = item.get('type')
-                                item_value = item.get('value')
-                                
-                                if item_type == 'empty':
-                                    ordered_results.append({
-                                        'STT': idx + 1,
-                                        'Dữ liệu gốc': item_value,
-                                        'Loại': '❓ Trống',
-                                        'qrcode': '',
-                                        'serial': '',
-                                        'Trạng thái': '⚠️ Trống'
-                                    })
-                                    not_found_count += 1
-                                elif item_type == 'serial':
-                                    # Sử dụng db_value (có prefix 26.) để tìm trong results_dict
-                                    db_value = item.get('db_value', item_value)
-                                    result = results_dict.get(db_value)
-                                    if result:
-                                        ordered_results.append({
-                                            'STT': idx + 1,
-                                            'Dữ liệu gốc': item_value,
-                                            'Loại': '🔢 Serial',
-                                            'qrcode': result.get('qrcode', ''),
-                                            'serial': result.get('serial', ''),
-                                            'Trạng thái': '✅ Tìm thấy'
-                                        })
-                                        found_count += 1
-                                    else:
-                                        ordered_results.append({
-                                            'STT': idx + 1,
-                                            'Dữ liệu gốc': item_value,
-                                            'Loại': '🔢 Serial',
-                                            'qrcode': '',
-                                            'serial': '',
-                                            'Trạng thái': '❌ Không tìm thấy'
-                                        })
-                                        not_found_count += 1
-                                elif item_type == 'qrcode':
-                                    result = results_dict.get(item_value)
-                                    if result:
-                                        ordered_results.append({
-                                            'STT': idx + 1,
-                                            'Dữ liệu gốc': item_value,
-                                            'Loại': '🔗 QR Code',
-                                            'qrcode': result.get('qrcode', ''),
-                                            'serial': result.get('serial', ''),
-                                            'Trạng thái': '✅ Tìm thấy'
-                                        })
-                                        found_count += 1
-                                    else:
-                                        ordered_results.append({
-                                            'STT': idx + 1,
-                                            'Dữ liệu gốc': item_value,
-                                            'Loại': '🔗 QR Code',
-                                            'qrcode': '',
-                                            'serial': '',
-                                            'Trạng thái': '❌ Không tìm thấy'
-                                        })
-                                        not_found_count += 1
+                            lookup_results = assemble_lookup_results(classified, results_dict)
+                            found_count = int((lookup_results['Trạng thái'] == STATUS_FOUND).sum())
+                            not_found_count = total_items - found_count
                             
                             progress_bar.progress(1.0)
                             status_text.text("✅ Hoàn thành tra cứu!")
                             
                             # Store results in session state
-                            st.session_state['lookup_results'] = ordered_results
+                            st.session_state['lookup_results'] = lookup_results
                             
                             # Display summary
                             st.success(f"🎉 Hoàn thành! Tìm thấy: {found_count}/{total_items} | Không tìm thấy: {not_found_count}/{total_items}")
@@ -1551,11 +2026,11 @@ def main():
                 st.info("💡 Đảm bảo file Excel của bạn có định dạng đúng (.xlsx hoặc .xls)")
         
         # Display results if available
-        if st.session_state['lookup_results']:
+        if st.session_state['lookup_results'] is not None:
             st.markdown("---")
             st.markdown("### 📊 Kết quả tra cứu")
             
-            df_results = pd.DataFrame(st.session_state['lookup_results'])
+            df_results = st.session_state['lookup_results']
             
             # Display statistics
             col_stat1, col_stat2, col_stat3 = st.columns(3)
@@ -1563,10 +2038,10 @@ def main():
                 total = len(df_results)
                 st.metric("📝 Tổng số dòng", total)
             with col_stat2:
-                found = len(df_results[df_results['Trạng thái'] == '✅ Tìm thấy'])
+                found = int((df_results['Trạng thái'] == STATUS_FOUND).sum())
                 st.metric("✅ Tìm thấy", found)
             with col_stat3:
-                not_found = len(df_results[df_results['Trạng thái'].isin(['❌ Không tìm thấy', '⚠️ Trống'])])
+                not_found = int(df_results['Trạng thái'].isin([STATUS_NOT_FOUND, STATUS_EMPTY]).sum())
                 st.metric("❌ Không tìm thấy", not_found)
             
             # Display results table
@@ -1618,7 +2093,7 @@ def main():
                 # Export only found results
                 if st.button("✅ Xuất kết quả tìm thấy", key="export_found_only"):
                     try:
-                        df_found = df_results[df_results['Trạng thái'] == '✅ Tìm thấy']
+                        df_found = df_results[df_results['Trạng thái'] == STATUS_FOUND]
                         
                         if len(df_found) == 0:
                             st.warning("⚠️ Không có kết quả nào được tìm thấy!")
@@ -1644,7 +2119,7 @@ def main():
                 if st.button("🔗 Xuất QR+Serial", key="export_qr_serial"):
                     try:
                         # Filter only found results
-                        df_found = df_results[df_results['Trạng thái'] == '✅ Tìm thấy']
+                        df_found = df_results[df_results['Trạng thái'] == STATUS_FOUND]
                         
                         if len(df_found) == 0:
                             st.warning("⚠️ Không có kết quả nào được tìm thấy!")
@@ -1688,5 +2163,10 @@ def main():
                     except Exception as e:
                         st.error(f"❌ Lỗi khi tạo file: {str(e)}")
 
+    # Rendered last so jobs queued during this run show up immediately
+    with st.sidebar:
+        render_export_jobs()
+        render_export_history()
+
 if __name__ == "__main__":
     main()